@@ -0,0 +1,60 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from db import get_connection
+
+COLUMNS = ('id', 'user_id', 'action', 'details', 'ip_address', 'timestamp')
+
+
+def archive_path(folder, month):
+    """Get the archive file for a YYYY-MM month"""
+    return os.path.join(folder, f'activity_log_{month}.jsonl.gz')
+
+
+def _append(path, rows):
+    """Append rows to a gzipped JSON Lines file and make sure they reach the disk"""
+    lines = ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows)
+    with open(path, 'ab') as raw:
+        # Each append adds a gzip member; readers see one continuous stream
+        with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+            f.write(lines.encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def archive_activity_log(retention_days, folder, batch_size=5000):
+    """Move activity rows older than the retention period into monthly archive files
+
+    Rows are deleted only after their batch is on disk, so an interrupted
+    run can at worst archive one batch twice. Returns the number of rows
+    archived.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    os.makedirs(folder, exist_ok=True)
+    conn = get_connection()
+    
+    archived = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, user_id, action, details, ip_address, timestamp
+            FROM activity_log
+            WHERE timestamp < ?
+            ORDER BY timestamp, id
+            LIMIT ?
+        ''', (cutoff, batch_size)).fetchall()
+        if not rows:
+            break
+        
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(str(row[5])[:7], []).append(row)
+        for month, month_rows in by_month.items():
+            _append(archive_path(folder, month), month_rows)
+        
+        with conn:
+            conn.executemany('DELETE FROM activity_log WHERE id = ?', [(row[0],) for row in rows])
+        archived += len(rows)
+    
+    return archived
@@ -1,15 +1,97 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify, make_response, Response, abort
+from markupsafe import Markup, escape
 from werkzeug.utils import secure_filename
-import sqlite3
+from werkzeug.http import dump_options_header
 import os
-from datetime import datetime
-import secrets
+import sqlite3
+from datetime import datetime, timezone
+import mimetypes
+from urllib.parse import quote
+
+import db
+from db import get_connection
+from database import migrate, get_schema_version, MIGRATIONS
+from models import User, Textbook, UploadSession, get_subjects, get_grades, get_catalogue_version
+from cache import LRUCache
+import uploads
+import storage
+import commands
+import passwords
+import metrics
+import assets
+import template_cache
+import previews
+import bundles
+import sessions
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+# Set SECRET_KEY in the environment for deployments; otherwise one is generated once in SECRET_KEY_FILE
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+app.config['SECRET_KEY_FILE'] = 'instance/secret_key'
 app.config['UPLOAD_FOLDER'] = 'uploads/textbooks'
+# 'local' keeps blobs under UPLOAD_FOLDER; 's3' keeps them in S3_BUCKET (any S3-compatible
+# service via S3_ENDPOINT_URL) and redirects downloads to presigned links
+app.config['STORAGE_BACKEND'] = 'local'
+app.config['S3_BUCKET'] = None
+app.config['S3_PREFIX'] = ''
+app.config['S3_ENDPOINT_URL'] = None
+app.config['S3_REGION'] = None
+app.config['S3_PRESIGN_EXPIRES'] = storage.PRESIGN_EXPIRES
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+app.config['DATABASE'] = 'school.db'
+app.config['MAX_UPLOAD_SIZE'] = 4 * 1024 * 1024 * 1024  # 4GB total for chunked uploads
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # chunk size suggested to clients
+# Let a front proxy send download bodies: set USE_X_SENDFILE for Apache/lighttpd, or an
+# internal location mapped to UPLOAD_FOLDER (e.g. '/protected-uploads/') for nginx
+app.config['USE_X_SENDFILE'] = False
+app.config['ACTIVITY_LOG_RETENTION_DAYS'] = 180
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['API_PAGE_SIZE'] = 50
+app.config['API_MAX_PAGE_SIZE'] = 500
+app.config['PASSWORD_HASH_METHOD'] = passwords.HASH_METHOD
+# None: passwords.WORKERS and MAX_PENDING, or under serve.py this worker's share of half the cores
+app.config['PASSWORD_HASH_WORKERS'] = None
+app.config['PASSWORD_HASH_MAX_PENDING'] = None
+app.config['ACTIVITY_LOG_ARCHIVE_FOLDER'] = 'archive/activity_log'
+app.config['X_ACCEL_REDIRECT_PREFIX'] = None
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 256
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024  # 32MB of rendered HTML
+app.config['SLOW_REQUEST_SECONDS'] = 0.5  # requests this slow are logged with their queries
+app.config['METRICS_FOLDER'] = 'cache/metrics'  # each worker's metrics, merged by whichever one /metrics reaches
+app.config['TEMPLATE_CACHE_FOLDER'] = 'cache/templates'  # compiled Jinja bytecode, shared by workers
+app.config['PREVIEW_WORKERS'] = previews.WORKERS  # processes rendering thumbnails and previews
+app.config['RECLAIM_GRACE_HOURS'] = 24  # unreferenced files this recent are left alone by reconcile-storage
+app.config['SCRUB_MB_PER_SECOND'] = 20  # read rate of checksum verification, so downloads keep the disk
+# serve.py (gunicorn): one worker process per core, each with a few threads, recycled after
+# SERVE_MAX_REQUESTS (plus up to the jitter, so they don't all restart at once)
+app.config['SERVE_BIND'] = '0.0.0.0:8000'
+app.config['SERVE_WORKERS'] = os.cpu_count() or 2
+app.config['SERVE_THREADS'] = 4
+app.config['SERVE_MAX_REQUESTS'] = 1000
+app.config['SERVE_MAX_REQUESTS_JITTER'] = 100
+app.config['SERVE_TIMEOUT'] = 60  # seconds a worker may go silent before it is restarted
+app.config['SERVE_GRACEFUL_TIMEOUT'] = 30  # seconds in-flight requests get on reload or shutdown
+app.config['SERVE_KEEPALIVE'] = 5
+db.init_app(app)
+storage.init_app(app)
+commands.init_app(app)
+passwords.init_app(app)
+metrics.init_app(app)
+assets.init_app(app)
+template_cache.init_app(app)
+previews.init_app(app)
+sessions.init_app(app)
+
+# Rendered grade catalogues keyed by (grade, catalogue version, is_admin)
+page_cache = LRUCache(app.config['PAGE_CACHE_MAX_ENTRIES'], app.config['PAGE_CACHE_MAX_BYTES'])
+metrics.Gauge('page_cache_entries', 'Rendered pages held in the page cache', lambda: page_cache.stats()['entries'])
+metrics.Gauge('page_cache_bytes', 'Bytes of rendered pages held in the page cache', lambda: page_cache.stats()['bytes'])
+metrics.Gauge('page_cache_hits_total', 'Page cache lookups that found a page',
+              lambda: page_cache.stats()['hits'], kind='counter')
+metrics.Gauge('page_cache_misses_total', 'Page cache lookups that had to render',
+              lambda: page_cache.stats()['misses'], kind='counter')
+metrics.Gauge('page_cache_evictions_total', 'Pages dropped to stay within the page cache limits',
+              lambda: page_cache.stats()['evictions'], kind='counter')
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'txt', 'jpg', 'jpeg', 'png', 'ppt', 'pptx', 'xls', 'xlsx', 'mp4', 'mp3', 'zip'}
@@ -18,45 +100,30 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # Database initialization
+DEFAULT_USERS = [
+    ('admin', 'admin@school.com', 'admin123', 'admin'),
+    ('student', 'student@school.com', 'student123', 'student')
+]
+
 def init_db():
-    conn = sqlite3.connect('school.db')
+    conn = get_connection()
     c = conn.cursor()
     
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  password_hash TEXT NOT NULL,
-                  user_type TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Textbooks table
-    c.execute('''CREATE TABLE IF NOT EXISTS textbooks
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  filename TEXT NOT NULL,
-                  original_name TEXT NOT NULL,
-                  grade INTEGER NOT NULL,
-                  subject TEXT NOT NULL,
-                  file_type TEXT NOT NULL,
-                  file_size INTEGER NOT NULL,
-                  uploaded_by TEXT NOT NULL,
-                  upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Create default admin user
-    admin_hash = generate_password_hash('admin123')
-    student_hash = generate_password_hash('student123')
+    # A current schema costs one pragma read; default users are only seeded when it was just created or upgraded
+    if not migrate(conn):
+        return
     
-    try:
-        c.execute("INSERT INTO users (username, email, password_hash, user_type) VALUES (?, ?, ?, ?)",
-                 ('admin', 'admin@school.com', admin_hash, 'admin'))
-        c.execute("INSERT INTO users (username, email, password_hash, user_type) VALUES (?, ?, ?, ?)",
-                 ('student', 'student@school.com', student_hash, 'student'))
-    except sqlite3.IntegrityError:
-        pass  # Users already exist
+    # Hashing is deliberately slow, so only hash for default users that are missing
+    c.execute('SELECT username FROM users WHERE username IN (?, ?)', [user[0] for user in DEFAULT_USERS])
+    existing = {row[0] for row in c.fetchall()}
+    missing = [user for user in DEFAULT_USERS if user[0] not in existing]
+    if not missing:
+        return
     
-    conn.commit()
-    conn.close()
+    with conn:
+        for username, email, password, user_type in missing:
+            c.execute("INSERT OR IGNORE INTO users (username, email, password_hash, user_type) VALUES (?, ?, ?, ?)",
+                      (username, email, passwords.hasher.hash(password), user_type))
 
 # Routes
 @app.route('/')
@@ -70,16 +137,18 @@ def login():
         password = request.form['password']
         user_type = request.form['user_type']
         
-        conn = sqlite3.connect('school.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username = ? AND user_type = ?", (username, user_type))
-        user = c.fetchone()
-        conn.close()
+        try:
+            user = User.authenticate(username, password, user_type)
+        except passwords.HashingBusy as e:
+            # Shed load quickly instead of queueing behind a burst of logins
+            flash('Too many people are signing in right now. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503, {'Retry-After': str(e.retry_after)}
         
-        if user and check_password_hash(user[3], password):
-            session['user_id'] = user[0]
-            session['username'] = user[1]
-            session['user_type'] = user[4]
+        if user:
+            session.regenerate()
+            session['user_id'] = user.id
+            session['username'] = user.username
+            session['user_type'] = user.user_type
             flash(f'Welcome, {username}!', 'success')
             return redirect(url_for('index'))
         else:
@@ -90,6 +159,7 @@ def login():
 @app.route('/logout')
 def logout():
     session.clear()
+    session.regenerate()
     flash('Logged out successfully', 'success')
     return redirect(url_for('index'))
 
@@ -123,18 +193,48 @@ def textbooks():
 
 @app.route('/textbooks/<int:grade>')
 def grade_textbooks(grade):
-    subjects = ['Mathematics', 'English', 'Science', 'Social Studies', 'Hindi', 'Computer Science', 'Art', 'Physical Education']
+    subjects = get_subjects()
+    is_admin = session.get('user_type') == 'admin'
     
-    conn = sqlite3.connect('school.db')
-    c = conn.cursor()
+    # Uploads and deletes bump the grade's catalogue version, so stale entries are never hit
+    cache_key = (grade, get_catalogue_version(grade), is_admin)
+    catalogue = page_cache.get(cache_key)
+    if catalogue is None:
+        # One indexed query for the whole grade, grouped by subject here
+        textbook_data = {subject: [] for subject in subjects}
+        for textbook in Textbook.iter_all_by_grade(grade):
+            textbook_data.setdefault(textbook.subject, []).append(textbook)
+        
+        catalogue = render_template('grade_catalogue.html', grade=grade, subjects=subjects,
+                                    textbooks=textbook_data, is_admin=is_admin,
+                                    preview_types=previews.preview_types())
+        page_cache.set(cache_key, catalogue)
+    
+    return render_template('grade_textbooks.html', grade=grade, subjects=subjects, catalogue=catalogue)
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    grade = request.args.get('grade', type=int)
+    subject = request.args.get('subject') or None
+    file_type = request.args.get('type') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    
+    results = []
+    if query:
+        # Fetch one extra row to know whether there is a next page
+        results = Textbook.search(query, grade, subject, file_type, limit=page_size + 1,
+                                  offset=(page - 1) * page_size)
+    has_next = len(results) > page_size
     
-    textbook_data = {}
-    for subject in subjects:
-        c.execute("SELECT * FROM textbooks WHERE grade = ? AND subject = ?", (grade, subject))
-        textbook_data[subject] = c.fetchall()
+    # Escape the snippet text before turning the match markers into highlights
+    results = [(textbook, Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>')))
+               for textbook, snippet in results[:page_size]]
     
-    conn.close()
-    return render_template('grade_textbooks.html', grade=grade, subjects=subjects, textbooks=textbook_data)
+    return render_template('search.html', query=query, grade=grade, subject=subject, file_type=file_type,
+                           results=results, page=page, has_next=has_next, grades=get_grades(),
+                           subjects=get_subjects(), file_types=sorted(ALLOWED_EXTENSIONS))
 
 @app.route('/upload_textbook', methods=['POST'])
 def upload_textbook():
@@ -160,20 +260,18 @@ def upload_textbook():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
         unique_filename = timestamp + filename
         
-        # Create grade/subject directory if it doesn't exist
-        upload_path = os.path.join(app.config['UPLOAD_FOLDER'], f'grade_{grade}', subject)
-        os.makedirs(upload_path, exist_ok=True)
-        
-        file_path = os.path.join(upload_path, unique_filename)
-        file.save(file_path)
+        # Store the content once, keyed by its SHA-256
+        sha256, file_size = storage.save_stream(file.stream)
+        metrics.upload_bytes.inc(file_size)
         
         # Save to database
-        conn = sqlite3.connect('school.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO textbooks (filename, original_name, grade, subject, file_type, file_size, uploaded_by) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                 (unique_filename, filename, grade, subject, filename.rsplit('.', 1)[1].lower(), os.path.getsize(file_path), session['username']))
-        conn.commit()
-        conn.close()
+        conn = get_connection()
+        with conn:
+            conn.execute("INSERT INTO textbooks (filename, original_name, grade, subject, file_type, file_size, uploaded_by, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (unique_filename, filename, grade, subject, filename.rsplit('.', 1)[1].lower(), file_size, session['username'], sha256))
+        
+        # Rendered in the preview worker pool, never on this thread
+        previews.schedule(sha256, filename.rsplit('.', 1)[1].lower(), storage.local_path(sha256))
         
         flash(f'File {filename} uploaded successfully!', 'success')
     else:
@@ -181,54 +279,418 @@ def upload_textbook():
     
     return redirect(request.referrer)
 
+# Chunked uploads: create a session, PUT chunks at the current offset, then finalize
+def upload_file_path(upload):
+    return storage.staging_path(f'upload_{upload.id}')
+
+def get_upload_or_error(upload_id):
+    if 'user_type' not in session or session['user_type'] != 'admin':
+        return None, (jsonify(error='Admin privileges required'), 403)
+    
+    upload = UploadSession.get_by_id(upload_id)
+    if not upload or upload.created_by != session['username']:
+        return None, (jsonify(error='Upload not found'), 404)
+    return upload, None
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    if 'user_type' not in session or session['user_type'] != 'admin':
+        return jsonify(error='Admin privileges required'), 403
+    
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get('filename', ''))
+    subject = data.get('subject')
+    try:
+        grade = int(data.get('grade'))
+        total_size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify(error='grade and size must be integers'), 400
+    
+    if not filename or not allowed_file(filename):
+        return jsonify(error='Invalid file type'), 400
+    if grade not in get_grades() or subject not in get_subjects():
+        return jsonify(error='Unknown grade or subject'), 400
+    if total_size <= 0:
+        return jsonify(error='File is empty'), 400
+    if total_size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify(error='File is too large'), 413
+    
+    unique_filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + filename
+    upload = UploadSession.create(unique_filename, filename, grade, subject,
+                                  filename.rsplit('.', 1)[1].lower(), total_size, session['username'])
+    
+    response = upload.to_dict()
+    response['chunk_size'] = app.config['UPLOAD_CHUNK_SIZE']
+    return jsonify(response), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload, error = get_upload_or_error(upload_id)
+    if error:
+        return error
+    return jsonify(upload.to_dict())
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def append_upload_chunk(upload_id):
+    upload, error = get_upload_or_error(upload_id)
+    if error:
+        return error
+    
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None or (request.content_length is not None and offset + request.content_length > upload.total_size):
+        return jsonify(error='Chunk extends past the declared size'), 400
+    
+    with uploads.locked(upload_file_path(upload)) as f:
+        # Another worker may have accepted a chunk while this request waited for the lock
+        upload = UploadSession.get_by_id(upload_id)
+        if upload is None:
+            return jsonify(error='Upload not found'), 404
+        if offset != upload.received:
+            # The client resumes from the offset we report
+            return jsonify(upload.to_dict()), 409
+        
+        received = uploads.append_chunk(f, offset, request.stream, upload.total_size)
+        metrics.upload_bytes.inc(received - offset)
+        upload.advance(received)
+    
+    return jsonify(upload.to_dict())
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    upload, error = get_upload_or_error(upload_id)
+    if error:
+        return error
+    if not upload.is_complete():
+        return jsonify(upload.to_dict()), 409
+    
+    file_path = upload_file_path(upload)
+    data = request.get_json(silent=True) or request.form
+    with uploads.locked(file_path) as f:
+        # A concurrent finalize or abort may have finished while this request waited for the lock
+        upload = UploadSession.get_by_id(upload_id)
+        if upload is None:
+            return jsonify(error='Upload not found'), 404
+        if not upload.is_complete():
+            return jsonify(upload.to_dict()), 409
+        
+        # Hash what is on disk rather than trusting any running state
+        sha256 = uploads.digest(f, upload.received)
+        expected = data.get('sha256')
+        if expected and expected.lower() != sha256:
+            # Corrupted in transit; the client has to start over
+            upload.delete()
+            os.remove(file_path)
+            return jsonify(error='Checksum mismatch', sha256=sha256), 422
+        
+        storage.store_file(file_path, sha256)
+        textbook_id = upload.finalize(sha256, data.get('description'))
+    if textbook_id is None:
+        return jsonify(error='Upload not found'), 404
+    
+    previews.schedule(sha256, upload.file_type, storage.local_path(sha256))
+    flash(f'File {upload.original_name} uploaded successfully!', 'success')
+    return jsonify(id=textbook_id, sha256=sha256, size=upload.total_size), 201
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    upload, error = get_upload_or_error(upload_id)
+    if error:
+        return error
+    
+    upload.delete()
+    file_path = upload_file_path(upload)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    return '', 204
+
 @app.route('/delete_textbook/<int:textbook_id>')
 def delete_textbook(textbook_id):
     if 'user_type' not in session or session['user_type'] != 'admin':
         flash('Access denied. Admin privileges required.', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect('school.db')
-    c = conn.cursor()
-    
-    # Get file info
-    c.execute("SELECT * FROM textbooks WHERE id = ?", (textbook_id,))
-    textbook = c.fetchone()
+    textbook = Textbook.get_by_id(textbook_id)
     
-    if textbook:
-        # Delete file from filesystem
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'grade_{textbook[3]}', textbook[4], textbook[1])
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # Delete from database
-        c.execute("DELETE FROM textbooks WHERE id = ?", (textbook_id,))
-        conn.commit()
-        flash(f'File {textbook[2]} deleted successfully!', 'success')
+    if textbook and textbook.is_active:
+        # Only the row is deactivated; reconcile-storage removes it and reclaims its file after the
+        # grace period, so an upload of the same content that is about to reference the blob can't lose it
+        textbook.delete()
+        flash(f'File {textbook.original_name} deleted successfully!', 'success')
     else:
         flash('File not found', 'error')
     
-    conn.close()
     return redirect(request.referrer)
 
+def textbook_file_path(textbook):
+    """Get the local file of a textbook, falling back to the pre-blob layout until migrated"""
+    if textbook.sha256:
+        file_path = storage.local_path(textbook.sha256)
+        if file_path and os.path.exists(file_path):
+            return file_path
+    return storage.legacy_path(textbook.grade, textbook.subject, textbook.filename)
+
+def open_textbook(textbook):
+    """Get (size, opener) for a textbook's stored content, or None if it is missing"""
+    if textbook.sha256 and storage.local_path(textbook.sha256) is None:
+        if not storage.exists(textbook.sha256):
+            return None
+        # Content-addressed rows record the exact size of their blob
+        return textbook.file_size, lambda: storage.open_blob(textbook.sha256)
+    
+    file_path = textbook_file_path(textbook)
+    if not os.path.exists(file_path):
+        return None
+    return os.path.getsize(file_path), lambda: open(file_path, 'rb')
+
+def content_disposition(filename):
+    """Build an attachment Content-Disposition, with an RFC 5987 name for non-ASCII filenames"""
+    try:
+        filename.encode('ascii')
+        return dump_options_header('attachment', {'filename': filename})
+    except UnicodeEncodeError:
+        return dump_options_header('attachment', {'filename': secure_filename(filename) or 'download',
+                                                  'filename*': "UTF-8''" + quote(filename)})
+
+def send_textbook(textbook, file_path):
+    """Send a textbook with a strong ETag, Range and conditional GET support"""
+    # The content hash is a strong validator; legacy rows get one from file metadata
+    etag = textbook.sha256 or True
+    last_modified = None
+    if textbook.upload_date:
+        last_modified = datetime.strptime(str(textbook.upload_date)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if not prefix:
+        # Werkzeug answers If-None-Match/If-Modified-Since with 304 and Range with 206
+        response = send_file(os.path.abspath(file_path), as_attachment=True, download_name=textbook.original_name,
+                             conditional=True, etag=etag, last_modified=last_modified)
+        response.accept_ranges = 'bytes'
+        if response.status_code in (200, 206):
+            metrics.download_bytes.inc(response.content_length or 0)
+        return response
+    
+    # nginx serves the bytes (and ranges) from its internal location; Flask only authorizes
+    mimetype = mimetypes.guess_type(textbook.original_name)[0] or 'application/octet-stream'
+    response = app.response_class(mimetype=mimetype)
+    relative_path = os.path.relpath(file_path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(relative_path)
+    response.headers['Content-Disposition'] = content_disposition(textbook.original_name)
+    if textbook.sha256:
+        response.set_etag(textbook.sha256)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+    if response.status_code == 200:
+        metrics.download_bytes.inc(textbook.file_size or 0)
+    return response
+
 @app.route('/download_textbook/<int:textbook_id>')
 def download_textbook(textbook_id):
-    conn = sqlite3.connect('school.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM textbooks WHERE id = ?", (textbook_id,))
-    textbook = c.fetchone()
-    conn.close()
-    
-    if textbook:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'grade_{textbook[3]}', textbook[4], textbook[1])
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True, download_name=textbook[2])
-        else:
-            flash('File not found', 'error')
-    else:
-        flash('File not found', 'error')
+    textbook = Textbook.get_by_id(textbook_id)
+    if not textbook or not textbook.is_active:
+        # Deleted textbooks stay in the table until the reconciler purges them
+        abort(404)
+    
+    if textbook.sha256:
+        # Remote storage sends the bytes itself through a short-lived signed link
+        mimetype = mimetypes.guess_type(textbook.original_name)[0] or 'application/octet-stream'
+        url = storage.download_url(textbook.sha256, content_disposition(textbook.original_name), mimetype)
+        if url:
+            metrics.download_bytes.inc(textbook.file_size or 0)
+            return redirect(url)
     
+    file_path = textbook_file_path(textbook)
+    if os.path.exists(file_path):
+        return send_textbook(textbook, file_path)
+    flash('File not found', 'error')
     return redirect(request.referrer)
 
+def bundle_response(load_textbooks, folder_by_subject, download_name, etag):
+    """Stream textbooks as one ZIP, sized up front when every file is stored as-is"""
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    
+    files = []
+    for textbook in load_textbooks():
+        stored = open_textbook(textbook)
+        if stored is None:
+            continue
+        name = textbook.original_name.replace('/', '_')
+        if folder_by_subject:
+            name = f'{textbook.subject}/{name}'
+        date_time = datetime.strptime(str(textbook.upload_date)[:19], '%Y-%m-%d %H:%M:%S').timetuple()[:6]
+        files.append((name, stored[0], stored[1], date_time, textbook.file_type))
+    if not files:
+        flash('No textbooks to download', 'error')
+        return redirect(request.referrer or url_for('textbooks'))
+    
+    entries = bundles.entries_for(files)
+    
+    def generate():
+        for chunk in bundles.stream_zip(entries):
+            metrics.download_bytes.inc(len(chunk))
+            yield chunk
+    
+    response = Response(generate(), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    length = bundles.zip_length(entries)
+    if length is not None:
+        response.content_length = length
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/textbooks/<int:grade>/bundle')
+def grade_bundle(grade):
+    # The catalogue version changes with any upload or delete in the grade
+    etag = f'bundle-{grade}-{get_catalogue_version(grade)}'
+    return bundle_response(lambda: Textbook.iter_all_by_grade(grade), True,
+                           f'grade_{grade}_textbooks.zip', etag)
+
+@app.route('/textbooks/<int:grade>/<subject>/bundle')
+def subject_bundle(grade, subject):
+    if subject not in get_subjects():
+        flash('Unknown subject', 'error')
+        return redirect(url_for('grade_textbooks', grade=grade))
+    etag = f'bundle-{grade}-{subject}-{get_catalogue_version(grade)}'
+    return bundle_response(lambda: Textbook.get_by_grade_and_subject(grade, subject), False,
+                           secure_filename(f'grade_{grade}_{subject}.zip'), etag)
+
+@app.route('/textbooks/<int:textbook_id>/preview')
+def textbook_preview(textbook_id):
+    textbook = Textbook.get_by_id(textbook_id)
+    if not textbook or not textbook.is_active or not textbook.sha256:
+        return '', 404
+    
+    preview_path = previews.preview_path(textbook.sha256)
+    if not os.path.exists(preview_path):
+        if storage.local_path(textbook.sha256) is None:
+            # Previews are only rendered from local storage; there is nothing to wait for
+            return '', 404
+        # Render in the background; the page hides the image until a later visit
+        previews.schedule(textbook.sha256, textbook.file_type, textbook_file_path(textbook))
+        response = make_response('', 404)
+        response.headers['Retry-After'] = 5
+        return response
+    
+    # Previews are keyed by content hash, so they never change for a given textbook
+    response = send_file(os.path.abspath(preview_path), mimetype='image/jpeg', conditional=True,
+                         etag=textbook.sha256, max_age=86400)
+    response.cache_control.public = True
+    return response
+
+# Read-only JSON catalogue API
+API_FIELDS = set(Textbook(file_size=0).to_dict())
+
+def get_api_fields_or_error():
+    """Get the fields asked for with ?fields=a,b, or None for all of them"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None, None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = set(fields) - API_FIELDS
+    if unknown:
+        return None, (jsonify(error=f"Unknown fields: {', '.join(sorted(unknown))}"), 400)
+    return fields, None
+
+def api_textbook(textbook, fields):
+    data = textbook.to_dict()
+    return data if fields is None else {field: data[field] for field in fields}
+
+def api_response(etag, build):
+    """Answer If-None-Match from the catalogue version alone, building the body only on a miss"""
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = build()
+        if isinstance(response, tuple):
+            return response
+        response = jsonify(response)
+    response.set_etag(etag)
+    # Clients may keep responses but must revalidate them, which is a cheap 304
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/textbooks')
+def api_textbooks():
+    grade = request.args.get('grade', type=int)
+    subject = request.args.get('subject') or None
+    file_type = request.args.get('type') or None
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int), 1),
+                app.config['API_MAX_PAGE_SIZE'])
+    fields, error = get_api_fields_or_error()
+    if error:
+        return error
+    
+    def build():
+        # Fetch one extra row to know whether there is a next page
+        textbooks = Textbook.get_page(grade, subject, file_type, after, limit + 1)
+        next_url = None
+        if len(textbooks) > limit:
+            textbooks = textbooks[:limit]
+            args = request.args.to_dict()
+            args['after'] = textbooks[-1].id
+            next_url = url_for('api_textbooks', **args)
+        return {
+            'textbooks': [api_textbook(textbook, fields) for textbook in textbooks],
+            'next': next_url
+        }
+    
+    scope = grade if grade is not None else 'all'
+    return api_response(f'textbooks-{scope}-{get_catalogue_version(grade)}', build)
+
+@app.route('/api/textbooks/<int:textbook_id>')
+def api_textbook_detail(textbook_id):
+    fields, error = get_api_fields_or_error()
+    if error:
+        return error
+    
+    def build():
+        textbook = Textbook.get_by_id(textbook_id)
+        if not textbook or not textbook.is_active:
+            return jsonify(error='Textbook not found'), 404
+        return api_textbook(textbook, fields)
+    
+    # The grade isn't known before the row is read, so validate against the whole catalogue
+    return api_response(f'textbook-{textbook_id}-{get_catalogue_version()}', build)
+
+@app.route('/api/grades/<int:grade>')
+def api_grade(grade):
+    if grade not in get_grades():
+        return jsonify(error='Grade not found'), 404
+    fields, error = get_api_fields_or_error()
+    if error:
+        return error
+    
+    version = get_catalogue_version(grade)
+    
+    def build():
+        subjects = {subject: [] for subject in get_subjects()}
+        for textbook in Textbook.iter_all_by_grade(grade):
+            subjects.setdefault(textbook.subject, []).append(api_textbook(textbook, fields))
+        return {'grade': grade, 'version': version, 'subjects': subjects}
+    
+    return api_response(f'grade-{grade}-{version}', build)
+
+@app.route('/healthz')
+def healthz():
+    """Health check for load balancers: the database answers and its schema is current"""
+    try:
+        version = get_schema_version(get_connection())
+    except sqlite3.Error as e:
+        response = jsonify(status='error', error=str(e)), 503
+    else:
+        if version < len(MIGRATIONS):
+            response = jsonify(status='migrating', schema_version=version), 503
+        else:
+            response = jsonify(status='ok', schema_version=version)
+    response = make_response(response)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
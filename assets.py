@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always built
+    brotli = None
+
+BUILD_FOLDER = 'dist'                  # under the static folder
+MANIFEST_NAME = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+# Fingerprinted files never change, so browsers may keep them for a year without asking
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_manifest = {}
+_fingerprinted = set()
+
+
+def load_manifest(static_folder):
+    """Read the manifest written by build_assets; without one, assets are served as they are"""
+    global _manifest, _fingerprinted
+    try:
+        with open(os.path.join(static_folder, BUILD_FOLDER, MANIFEST_NAME)) as f:
+            _manifest = json.load(f)
+    except FileNotFoundError:
+        _manifest = {}
+    _fingerprinted = set(_manifest.values())
+    return _manifest
+
+
+def _write_if_missing(path, data):
+    if os.path.exists(path):
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_assets(static_folder):
+    """Copy static files to content-hashed names with gzip and brotli variants, and write the manifest
+
+    Earlier builds are left in place, so pages rendered before a deploy keep
+    working until their cached copies expire.
+    """
+    build_root = os.path.join(static_folder, BUILD_FOLDER)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) and BUILD_FOLDER in dirs:
+            dirs.remove(BUILD_FOLDER)
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(relative)
+            fingerprinted = f'{BUILD_FOLDER}/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+            destination = os.path.join(static_folder, fingerprinted)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            _write_if_missing(destination, data)
+
+            if ext.lower() in COMPRESSIBLE:
+                # mtime=0 keeps the gzip bytes identical between builds
+                _write_if_missing(destination + '.gz', gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    _write_if_missing(destination + '.br', brotli.compress(data, quality=11))
+            manifest[relative] = fingerprinted
+
+    os.makedirs(build_root, exist_ok=True)
+    manifest_path = os.path.join(build_root, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    load_manifest(static_folder)
+    return manifest
+
+
+def init_app(app):
+    """Resolve url_for('static') through the manifest and serve fingerprinted files precompressed"""
+    load_manifest(app.static_folder)
+
+    @app.url_defaults
+    def _fingerprint_static_urls(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in _manifest:
+            values['filename'] = _manifest[values['filename']]
+
+    default_static = app.view_functions['static']
+
+    def static(filename):
+        if filename not in _fingerprinted:
+            return default_static(filename=filename)
+
+        served, encoding = filename, None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[candidate] and os.path.exists(os.path.join(app.static_folder, filename + suffix)):
+                served, encoding = filename + suffix, candidate
+                break
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(app.static_folder, served, mimetype=mimetype, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    app.view_functions['static'] = static
@@ -0,0 +1,119 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchWriter:
+    """Queue rows in memory and insert them from a background thread in batches
+
+    A batch is written with executemany in a single transaction once it holds
+    batch_size rows or its first row has waited flush_interval seconds. When
+    the queue is full, callers block for up to put_timeout seconds and then
+    write their row themselves, so nothing is dropped under load.
+    """
+
+    def __init__(self, sql, batch_size=200, flush_interval=0.5, max_queue=10000, put_timeout=2.0):
+        self.sql = sql
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.batches_written = 0
+        self.rows_written = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        """Start the writer thread on first use in this process"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            # After fork() the parent still owns the rows it had queued
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_queue)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+            self._thread.start()
+
+    def put(self, row):
+        """Queue a row for writing"""
+        self._ensure_started()
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning('Write queue full; writing row synchronously')
+            self._write([row])
+
+    def flush(self):
+        """Block until every queued row has been written"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Write everything still queued and stop the writer thread"""
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, rows):
+        """Insert rows in one transaction, retrying briefly if the database stays locked"""
+        conn = get_connection()
+        for attempt in range(3):
+            try:
+                with conn:
+                    conn.executemany(self.sql, rows)
+                break
+            except Exception:
+                if attempt == 2:
+                    logger.exception('Dropped %d rows after repeated write failures', len(rows))
+                    return
+                time.sleep(0.1 * (attempt + 1))
+
+        with self._lock:
+            self.batches_written += 1
+            self.rows_written += len(rows)
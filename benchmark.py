@@ -0,0 +1,280 @@
+"""Micro-benchmarks for the models and routes against a synthetic database
+
+    python benchmark.py --users 10000 --textbooks 100000 --activities 1000000 --output results.json
+    python benchmark.py --baseline results.json --threshold 0.2
+
+The generated database is kept under --data-dir and reused by later runs at
+the same scale and seed. Each run works on a temporary copy of it, so the
+benchmarks that write (logins, activity logging) never change what the next
+run measures.
+"""
+from contextlib import closing
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+import db
+from database import migrate
+from models import User, Textbook, ActivityLog, get_subjects, get_grades, get_textbook_stats
+import passwords
+
+PASSWORD = 'benchmark123'
+WORDS = ['algebra', 'geometry', 'reading', 'poems', 'plants', 'animals', 'history', 'maps',
+         'drawing', 'computers', 'fractions', 'grammar', 'stories', 'energy', 'numbers', 'india']
+FILE_TYPES = ['pdf', 'pdf', 'pdf', 'docx', 'pptx', 'jpg', 'mp4', 'zip']
+INSERT_BATCH = 50000
+
+
+def database_path(data_dir, users, textbooks, activities, seed):
+    return os.path.join(data_dir, f'bench_u{users}_t{textbooks}_a{activities}_s{seed}.db')
+
+
+def copy_database(path, directory):
+    """Copy a generated database into directory for one run, brought up to the current schema"""
+    copy = os.path.join(directory, os.path.basename(path))
+    with closing(sqlite3.connect(path)) as source, closing(sqlite3.connect(copy)) as target:
+        source.backup(target)
+    conn = db.connect(copy)
+    migrate(conn)
+    conn.close()
+    return copy
+
+
+def _batches(rows, size=INSERT_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate_database(path, users, textbooks, activities, seed=0):
+    """Build a school database of the given size with reproducible random content"""
+    rng = random.Random(seed)
+    building = path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+
+    conn = db.connect(building)
+    migrate(conn)
+
+    # Every user shares one password so generating them doesn't take hours of scrypt
+    password_hash = passwords.hasher.hash(PASSWORD)
+    with conn:
+        conn.executemany('''
+            INSERT INTO users (username, email, password_hash, user_type, first_name, last_name)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', ((f'user{i}', f'user{i}@example.com', password_hash, 'admin' if i % 100 == 0 else 'student',
+               f'First{i}', f'Last{i}') for i in range(users)))
+
+    start = datetime(2024, 1, 1)
+    subjects = get_subjects()
+    rows = ((f'book_{i}.{file_type}', f"{' '.join(rng.sample(WORDS, 3)).title()} {i}.{file_type}",
+             rng.choice(get_grades()), rng.choice(subjects), file_type, rng.randint(10000, 50000000),
+             f'user{rng.randrange(0, max(users, 1), 100)}', ' '.join(rng.sample(WORDS, 6)),
+             (start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'), int(rng.random() > 0.05))
+            for i, file_type in ((i, rng.choice(FILE_TYPES)) for i in range(textbooks)))
+    for batch in _batches(rows):
+        with conn:
+            conn.executemany('''
+                INSERT INTO textbooks (filename, original_name, grade, subject, file_type, file_size,
+                                     uploaded_by, description, upload_date, is_active)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+
+    actions = ['LOGIN', 'LOGIN', 'LOGIN', 'TEXTBOOK_DOWNLOADED', 'TEXTBOOK_UPLOADED', 'PASSWORD_CHANGED']
+    span = 2 * 365 * 24 * 3600
+    rows = ((rng.randint(1, max(users, 1)), rng.choice(actions), 'benchmark event', '10.0.0.1',
+             (start + timedelta(seconds=rng.randrange(span))).strftime('%Y-%m-%d %H:%M:%S'))
+            for _ in range(activities))
+    for batch in _batches(rows):
+        with conn:
+            conn.executemany('''
+                INSERT INTO activity_log (user_id, action, details, ip_address, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', batch)
+
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    os.replace(building, path)
+
+
+def measure(fn, iterations, max_seconds, warmup):
+    """Time calls of fn, stopping after iterations calls or max_seconds"""
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    while len(samples) < iterations and (not samples or time.perf_counter() < deadline):
+        started = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - started)
+
+    samples.sort()
+    mean = sum(samples) / len(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(round(p * (len(samples) - 1))))] / 1e6
+
+    return {
+        'iterations': len(samples),
+        'p50_ms': round(percentile(0.50), 4),
+        'p95_ms': round(percentile(0.95), 4),
+        'mean_ms': round(mean / 1e6, 4),
+        'ops_per_sec': round(1e9 / mean, 1) if mean else None
+    }
+
+
+def build_benchmarks(users, seed=0):
+    """Get (name, callable, max iterations) for every benchmark"""
+    from app import app, page_cache
+
+    rng = random.Random(seed)
+    grades, subjects = get_grades(), get_subjects()
+    client = app.test_client()
+
+    def authenticate():
+        # Every hundredth user is an admin, the rest are students
+        username = f'user{rng.randrange(1, max(users, 2))}'
+        user_type = 'admin' if int(username[4:]) % 100 == 0 else 'student'
+        assert User.authenticate(username, PASSWORD, user_type)
+
+    def get_by_grade_and_subject():
+        Textbook.get_by_grade_and_subject(rng.choice(grades), rng.choice(subjects))
+
+    def get_by_id():
+        Textbook.get_by_id(rng.randint(1, 1000))
+
+    def log_activity():
+        ActivityLog.log_activity(rng.randint(1, max(users, 1)), 'BENCHMARK', 'benchmark event')
+
+    def recent_activities():
+        ActivityLog.get_recent_activities(100)
+
+    def route(path_fn, clear_cache=False):
+        def call():
+            if clear_cache:
+                page_cache.clear()
+            response = client.get(path_fn())
+            assert response.status_code == 200, response.status_code
+            response.close()
+        return call
+
+    return [
+        ('User.authenticate', authenticate, 50),
+        ('Textbook.get_by_grade_and_subject', get_by_grade_and_subject, 2000),
+        ('Textbook.get_by_id', get_by_id, 5000),
+        ('ActivityLog.log_activity', log_activity, 20000),
+        ('ActivityLog.get_recent_activities', recent_activities, 2000),
+        ('get_textbook_stats', get_textbook_stats, 5000),
+        ('GET /textbooks/<grade>', route(lambda: f'/textbooks/{rng.choice(grades)}'), 1000),
+        ('GET /textbooks/<grade> (uncached)', route(lambda: f'/textbooks/{rng.choice(grades)}', True), 200),
+        ('GET /api/textbooks', route(lambda: f'/api/textbooks?grade={rng.choice(grades)}'), 1000),
+        ('GET /search', route(lambda: f'/search?q={rng.choice(WORDS)}+{rng.choice(WORDS)[:3]}'), 200)
+    ]
+
+
+def compare(results, baseline, threshold):
+    """Get (name, baseline p50, current p50, change) for benchmarks slower than baseline by over threshold"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before['p50_ms']:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1
+        if change > threshold:
+            regressions.append((name, before['p50_ms'], result['p50_ms'], change))
+    return regressions
+
+
+@click.command()
+@click.option('--users', default=10000, show_default=True)
+@click.option('--textbooks', default=100000, show_default=True)
+@click.option('--activities', default=1000000, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--data-dir', default='benchmark_data', show_default=True, help='Where generated databases are kept')
+@click.option('--only', multiple=True, help='Run only benchmarks whose name contains this text')
+@click.option('--max-seconds', default=10.0, show_default=True, help='Time limit per benchmark')
+@click.option('--warmup', default=5, show_default=True, help='Untimed calls before measuring')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Write results JSON here')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Compare against a saved results JSON and fail on regressions')
+@click.option('--threshold', default=0.2, show_default=True, help='Allowed p50 slowdown against the baseline')
+def main(users, textbooks, activities, seed, data_dir, only, max_seconds, warmup, output, baseline, threshold):
+    """Time model methods and routes against a synthetic database"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = database_path(data_dir, users, textbooks, activities, seed)
+    if not os.path.exists(path):
+        click.echo(f'Generating {path} ({users} users, {textbooks} textbooks, {activities} log rows)...', err=True)
+        started = time.monotonic()
+        generate_database(path, users, textbooks, activities, seed)
+        click.echo(f'✓ Generated in {time.monotonic() - started:.1f}s', err=True)
+
+    run_dir = tempfile.mkdtemp(prefix='run_', dir=data_dir)
+    try:
+        run_path = copy_database(path, run_dir)
+
+        # Importing app points db at its own DATABASE, so switch to the copy afterwards
+        from app import app
+        app.config['DATABASE'] = run_path
+        db.configure(database=run_path)
+
+        results = {}
+        for name, fn, iterations in build_benchmarks(users, seed):
+            if only and not any(text in name for text in only):
+                continue
+            results[name] = measure(fn, iterations, max_seconds, warmup)
+            result = results[name]
+            click.echo(f"{name:40} p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+                       f"{result['ops_per_sec']:>10} ops/s", err=True)
+        ActivityLog.flush()
+    finally:
+        db.close_all()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'users': users,
+            'textbooks': textbooks,
+            'activities': activities,
+            'seed': seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        click.echo(f'✓ Results written to {output}', err=True)
+    else:
+        click.echo(json.dumps(report, indent=2))
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)['results'], threshold)
+        for name, before, after, change in regressions:
+            click.echo(f'✗ {name}: p50 {before:.3f} ms -> {after:.3f} ms (+{change:.0%})', err=True)
+        if regressions:
+            sys.exit(1)
+        click.echo(f'✓ No regressions over {threshold:.0%} against {baseline}', err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+from contextlib import closing
+import os
+import struct
+import zlib
+
+BLOCK_SIZE = 1024 * 1024
+
+# Formats that are already compressed; deflating them again only costs CPU
+STORED_TYPES = {'pdf', 'mp4', 'mp3', 'zip', 'jpg', 'jpeg', 'png', 'docx', 'pptx', 'xlsx'}
+
+ZIP32_LIMIT = 0xFFFFFFFF
+# Deflate can grow incompressible data slightly, so switch to ZIP64 a little early
+ZIP64_THRESHOLD = ZIP32_LIMIT - 0x100000
+FLAGS = 0x08 | 0x800            # sizes follow the data in a descriptor; names are UTF-8
+STORED, DEFLATED = 0, 8
+
+
+class ZipEntry:
+    """A file to add to a streamed ZIP"""
+
+    __slots__ = ('name', 'open', 'size', 'date_time', 'method', 'crc', 'compressed_size', 'offset')
+
+    def __init__(self, name, open, size, date_time, compress):
+        self.name = name.encode('utf-8')
+        self.open = open
+        self.size = size
+        self.date_time = date_time
+        self.method = DEFLATED if compress else STORED
+        self.crc = 0
+        self.compressed_size = size if not compress else 0
+        self.offset = 0
+
+    @property
+    def zip64(self):
+        return self.size >= ZIP64_THRESHOLD
+
+    def _dos_date_time(self):
+        year, month, day, hour, minute, second = self.date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+
+    def local_header(self):
+        version = 45 if self.zip64 else 20
+        dos_time, dos_date = self._dos_date_time()
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if self.zip64 else b''
+        placeholder = ZIP32_LIMIT if self.zip64 else 0
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, FLAGS, self.method, dos_time, dos_date,
+                           0, placeholder, placeholder, len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.compressed_size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.compressed_size, self.size)
+
+    def central_header(self):
+        dos_time, dos_date = self._dos_date_time()
+        extra_fields = []
+        if self.zip64:
+            extra_fields += [self.size, self.compressed_size]
+        if self.offset >= ZIP32_LIMIT:
+            extra_fields.append(self.offset)
+        extra = b''
+        if extra_fields:
+            extra = struct.pack(f'<HH{len(extra_fields)}Q', 0x0001, 8 * len(extra_fields), *extra_fields)
+        version = 45 if extra else 20
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, FLAGS,
+                           self.method, dos_time, dos_date, self.crc,
+                           ZIP32_LIMIT if self.zip64 else self.compressed_size,
+                           ZIP32_LIMIT if self.zip64 else self.size,
+                           len(self.name), len(extra), 0, 0, 0, 0o100644 << 16,
+                           min(self.offset, ZIP32_LIMIT)) + self.name + extra
+
+
+def _end_records(count, directory_offset, directory_size):
+    records = b''
+    if count >= 0xFFFF or directory_offset >= ZIP32_LIMIT or directory_size >= ZIP32_LIMIT:
+        zip64_offset = directory_offset + directory_size
+        records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                               count, count, directory_size, directory_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+    return records + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(directory_size, ZIP32_LIMIT), min(directory_offset, ZIP32_LIMIT), 0)
+
+
+def zip_length(entries):
+    """Get the exact size of the ZIP stream_zip will produce, or None if any entry is deflated"""
+    if any(entry.method != STORED for entry in entries):
+        return None
+    offset = 0
+    for entry in entries:
+        entry.offset = offset
+        offset += len(entry.local_header()) + entry.size + len(entry.data_descriptor())
+    directory_size = sum(len(entry.central_header()) for entry in entries)
+    return offset + directory_size + len(_end_records(len(entries), offset, directory_size))
+
+
+def stream_zip(entries, block_size=BLOCK_SIZE):
+    """Yield a ZIP of entries piece by piece, reading each file once and holding one block at a time"""
+    offset = 0
+    for entry in entries:
+        entry.offset = offset
+        header = entry.local_header()
+        yield header
+        offset += len(header)
+
+        crc = 0
+        compressed = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if entry.method == DEFLATED else None
+        with closing(entry.open()) as f:
+            remaining = entry.size
+            while remaining:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    raise IOError(f'{entry.name.decode()} is shorter than {entry.size} bytes')
+                remaining -= len(block)
+                crc = zlib.crc32(block, crc)
+                if compressor:
+                    block = compressor.compress(block)
+                if block:
+                    compressed += len(block)
+                    yield block
+        if compressor:
+            block = compressor.flush()
+            compressed += len(block)
+            yield block
+
+        entry.crc = crc
+        entry.compressed_size = compressed
+        descriptor = entry.data_descriptor()
+        yield descriptor
+        offset += compressed + len(descriptor)
+
+    directory = b''.join(entry.central_header() for entry in entries)
+    yield directory
+    yield _end_records(len(entries), offset, len(directory))
+
+
+def entries_for(files):
+    """Build ZIP entries from (name, size, open, date_time, file_type) tuples, giving repeated names a suffix
+
+    open is called with no arguments to get a binary file-like object once
+    the entry's turn comes.
+    """
+    entries = []
+    used = set()
+    for name, size, open, date_time, file_type in files:
+        name = name.replace('\\', '_').lstrip('/')
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 2
+        while candidate.lower() in used:
+            candidate = f'{stem} ({n}){ext}'
+            n += 1
+        used.add(candidate.lower())
+        entries.append(ZipEntry(candidate, open, size, date_time, compress=file_type not in STORED_TYPES))
+    return entries
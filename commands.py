@@ -0,0 +1,245 @@
+import csv
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from db import get_connection
+from database import rebuild_stats_counters
+from models import Blob, ActivityLog
+import storage
+from activity_archive import archive_activity_log
+import importer
+import assets
+import template_cache
+import previews
+import reconcile
+
+
+def init_app(app):
+    """Register maintenance commands with the flask CLI"""
+    app.cli.add_command(migrate_uploads_command)
+    app.cli.add_command(archive_activity_command)
+    app.cli.add_command(import_textbooks_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(export_activity_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(precompile_templates_command)
+    app.cli.add_command(backfill_previews_command)
+    app.cli.add_command(reconcile_storage_command)
+
+
+@click.command('migrate-uploads')
+@with_appcontext
+def migrate_uploads_command():
+    """Move grade/subject upload folders into the content-addressed blob store"""
+    conn = get_connection()
+    rows = conn.execute('SELECT id, grade, subject, filename FROM textbooks').fetchall()
+    
+    converted = 0
+    for textbook_id, sha256, size in storage.migrate_legacy_uploads(rows):
+        # Commit the hash before the generator moves the file
+        with conn:
+            conn.execute('UPDATE textbooks SET sha256 = ?, file_size = ? WHERE id = ?',
+                         (sha256, size, textbook_id))
+        converted += 1
+    
+    Blob.rebuild_ref_counts()
+    deduplicated = conn.execute('SELECT COUNT(*) - COUNT(DISTINCT sha256) FROM textbooks WHERE sha256 IS NOT NULL').fetchone()[0]
+    click.echo(f'✓ Migrated {converted} files into {storage.backend.location}')
+    click.echo(f'✓ {deduplicated} textbooks share content with another textbook')
+
+
+@click.command('archive-activity')
+@click.option('--days', type=int, default=None,
+              help='Keep this many days in the database (default: ACTIVITY_LOG_RETENTION_DAYS)')
+@with_appcontext
+def archive_activity_command(days):
+    """Move old activity log rows into compressed monthly archive files"""
+    if days is None:
+        days = current_app.config['ACTIVITY_LOG_RETENTION_DAYS']
+    folder = current_app.config['ACTIVITY_LOG_ARCHIVE_FOLDER']
+    
+    archived = archive_activity_log(days, folder)
+    click.echo(f'✓ Archived {archived} activity log rows older than {days} days to {folder}')
+
+
+@click.command('import-textbooks')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--uploaded-by', default='admin', show_default=True, help='Username recorded as the uploader')
+@click.option('--workers', default=8, show_default=True, help='Files hashed and copied in parallel')
+@click.option('--dry-run', is_flag=True, help='Hash and validate files without storing anything')
+@with_appcontext
+def import_textbooks_command(source, uploaded_by, workers, dry_run):
+    """Bulk import textbooks from a grade_N/<Subject>/ tree or a CSV manifest"""
+    from app import ALLOWED_EXTENSIONS
+    
+    if source.lower().endswith('.csv'):
+        entries = importer.read_manifest(source)
+    else:
+        entries = importer.walk_directory(source)
+    click.echo(f'Found {len(entries)} files')
+    
+    started = time.monotonic()
+    last_report = [started]
+    
+    def progress(done, total, bytes_done):
+        now = time.monotonic()
+        if now - last_report[0] >= 1 or done == total:
+            last_report[0] = now
+            rate = bytes_done / (1024 * 1024) / max(now - started, 1e-9)
+            click.echo(f'  {done}/{total} files, {bytes_done / (1024 * 1024):.1f} MB, {rate:.1f} MB/s')
+    
+    report = importer.import_textbooks(entries, uploaded_by, ALLOWED_EXTENSIONS,
+                                       dry_run=dry_run, workers=workers, progress=progress)
+    
+    for path, error in report['skipped']:
+        click.echo(f'✗ Skipped {path}: {error}')
+    verb = 'Would import' if dry_run else 'Imported'
+    click.echo(f"✓ {verb} {report['imported']} textbooks ({report['unique_files']} unique files, "
+               f"{report['bytes'] / (1024 * 1024):.1f} MB) in {report['seconds']:.1f}s: "
+               f"{report['files_per_second']:.1f} files/s, {report['mb_per_second']:.1f} MB/s")
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute the trigger-maintained summary counters from the tables"""
+    rebuild_stats_counters(get_connection())
+    click.echo('✓ Statistics counters rebuilt')
+
+
+@click.command('export-activity')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='CSV file to write (default: stdout)')
+@click.option('--user-id', type=int, default=None, help='Only export this user\'s activity')
+@with_appcontext
+def export_activity_command(output, user_id):
+    """Export the activity log as CSV, newest first, streaming rows from the database"""
+    ActivityLog.flush()
+    if user_id is None:
+        activities = ActivityLog.iter_recent_activities()
+    else:
+        activities = ActivityLog.iter_user_activities(user_id)
+    
+    f = open(output, 'w', newline='', encoding='utf-8') if output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'timestamp', 'user_id', 'username', 'action', 'details', 'ip_address'])
+        exported = 0
+        for activity in activities:
+            writer.writerow([activity.id, activity.timestamp, activity.user_id, activity.username,
+                             activity.action, activity.details, activity.ip_address])
+            exported += 1
+    finally:
+        if output:
+            f.close()
+    
+    if output:
+        click.echo(f'✓ Exported {exported} activity log rows to {output}')
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Write fingerprinted, precompressed copies of the static files and their manifest"""
+    manifest = assets.build_assets(current_app.static_folder)
+    for source, fingerprinted in sorted(manifest.items()):
+        click.echo(f'  {source} -> {fingerprinted}')
+    if assets.brotli is None:
+        click.echo('! brotli is not installed; only gzip variants were written')
+    click.echo(f'✓ Built {len(manifest)} assets into {assets.BUILD_FOLDER}/')
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Compile every template into the Jinja bytecode cache ahead of the first request"""
+    started = time.monotonic()
+    names = template_cache.precompile(current_app)
+    click.echo(f'✓ Compiled {len(names)} templates into {current_app.config["TEMPLATE_CACHE_FOLDER"]} '
+               f'in {time.monotonic() - started:.2f}s')
+
+
+@click.command('backfill-previews')
+@click.option('--workers', type=int, default=None, help='Rendering processes (default: PREVIEW_WORKERS)')
+@with_appcontext
+def backfill_previews_command(workers):
+    """Render previews for stored textbooks that don't have one yet"""
+    types = previews.preview_types()
+    if not types:
+        click.echo('✗ No preview renderer available (install Pillow for images, poppler-utils for PDFs)')
+        return
+    if workers:
+        previews.WORKERS = workers
+    
+    conn = get_connection()
+    placeholders = ', '.join('?' for _ in types)
+    rows = conn.execute(f'''
+        SELECT sha256, MIN(file_type) FROM textbooks
+        WHERE sha256 IS NOT NULL AND is_active = 1 AND file_type IN ({placeholders})
+        GROUP BY sha256
+    ''', sorted(types)).fetchall()
+    
+    def progress(done, total):
+        if done % 50 == 0 or done == total:
+            click.echo(f'  {done}/{total} previews')
+    
+    # Renderers need local files, so blobs in remote storage are skipped
+    rendered, failed = previews.backfill(((sha256, file_type, storage.local_path(sha256))
+                                          for sha256, file_type in rows
+                                          if storage.local_path(sha256) and storage.exists(sha256)), progress)
+    click.echo(f'✓ Rendered {rendered} previews for {", ".join(sorted(types))} files; {failed} could not be rendered')
+
+
+@click.command('reconcile-storage')
+@click.option('--grace-hours', type=float, default=None,
+              help='Only reclaim files unreferenced for this long (default: RECLAIM_GRACE_HOURS)')
+@click.option('--workers', default=reconcile.WORKERS, show_default=True, help='Shard directories scanned in parallel')
+@click.option('--dry-run', is_flag=True, help='Report what would be reclaimed without removing anything')
+@click.option('--verify-mb', type=float, default=0, show_default=True,
+              help='Also re-hash up to this many MB of blobs, least recently verified first')
+@click.option('--rate-mb', type=float, default=None,
+              help='Verification read rate in MB/s, 0 for unlimited (default: SCRUB_MB_PER_SECOND)')
+@with_appcontext
+def reconcile_storage_command(grace_hours, workers, dry_run, verify_mb, rate_mb):
+    """Reclaim unreferenced files, report missing ones and optionally verify checksums"""
+    if grace_hours is None:
+        grace_hours = current_app.config['RECLAIM_GRACE_HOURS']
+    if rate_mb is None:
+        rate_mb = current_app.config['SCRUB_MB_PER_SECOND']
+    problems = 0
+    
+    report = reconcile.reconcile(grace_hours * 3600, workers, dry_run)
+    for textbook_id, original_name in report['missing']:
+        click.echo(f'✗ Textbook {textbook_id} ({original_name}) has no stored file')
+    problems += len(report['missing'])
+    verb = 'Would reclaim' if dry_run else 'Reclaimed'
+    if isinstance(storage.backend, storage.LocalStorage):
+        click.echo(f"✓ Scanned {report['scanned_files']} blobs ({report['scanned_bytes'] / (1024 * 1024):.1f} MB) "
+                   f"in {report['seconds']:.1f}s")
+    else:
+        click.echo(f"! Skipped the blob scan: {storage.backend.location} is not a local folder; "
+                   f"{report['unreferenced_blobs']} unreferenced blobs are left in it")
+    click.echo(f"✓ {verb} {report['reclaimed_files']} unreferenced blobs "
+               f"({report['reclaimed_bytes'] / (1024 * 1024):.1f} MB), {report['purged_textbooks']} soft-deleted "
+               f"textbooks, {report['expired_uploads']} abandoned uploads, {report['stale_staging']} staged files "
+               f"and {report['orphaned_previews']} previews; forgot {report['forgotten_blobs']} blobs without files")
+    
+    if verify_mb:
+        def progress(done, total):
+            if done % 100 == 0 or done == total:
+                click.echo(f'  {done}/{total} blobs verified')
+        
+        report = reconcile.verify_blobs(int(verify_mb * 1024 * 1024), int(rate_mb * 1024 * 1024), progress)
+        for sha256 in report['corrupt']:
+            click.echo(f'✗ Blob {sha256} does not match its checksum')
+        for sha256 in report['missing']:
+            click.echo(f'✗ Blob {sha256} is missing')
+        problems += len(report['corrupt']) + len(report['missing'])
+        click.echo(f"✓ Verified {report['verified']} blobs ({report['bytes'] / (1024 * 1024):.1f} MB) "
+                   f"in {report['seconds']:.1f}s")
+    
+    if problems:
+        sys.exit(1)
@@ -3,14 +3,65 @@ from werkzeug.security import generate_password_hash
 import os
 from datetime import datetime
 
-def init_database():
-    """Initialize the SQLite database with tables and sample data"""
-    
-    # Create database connection
-    conn = sqlite3.connect('school.db')
-    c = conn.cursor()
-    
-    # Create users table
+from db import get_connection
+
+# Summary counters kept exact by triggers: (counter, table, key column, row condition)
+STATS_COUNTERS = [
+    ('textbooks_by_grade', 'textbooks', 'grade', None),
+    ('active_textbooks_by_grade', 'textbooks', 'grade', '{row}.is_active = 1'),
+    ('active_textbooks_by_subject', 'textbooks', 'subject', '{row}.is_active = 1'),
+    ('users_by_type', 'users', 'user_type', None),
+    ('active_users_by_type', 'users', 'user_type', '{row}.is_active = 1'),
+]
+
+def _counter_condition(condition, row):
+    return condition.format(row=row) if condition else '1'
+
+def create_stats_triggers(c):
+    """Create the triggers that keep stats_counters in step with textbooks and users"""
+    for table, watched in [('textbooks', 'is_active, grade, subject'), ('users', 'is_active, user_type')]:
+        counters = [counter for counter in STATS_COUNTERS if counter[1] == table]
+        add = ''.join(f'''
+            INSERT INTO stats_counters (name, key, count)
+            SELECT '{name}', NEW.{key}, 1 WHERE {_counter_condition(condition, 'NEW')}
+            ON CONFLICT (name, key) DO UPDATE SET count = count + 1;''' for name, _, key, condition in counters)
+        remove = ''.join(f'''
+            UPDATE stats_counters SET count = count - 1
+            WHERE name = '{name}' AND key = OLD.{key} AND {_counter_condition(condition, 'OLD')};''' for name, _, key, condition in counters)
+        
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_insert AFTER INSERT ON {table} BEGIN {add} END')
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_delete AFTER DELETE ON {table} BEGIN {remove} END')
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_update AFTER UPDATE OF {watched} ON {table} '
+                  f'BEGIN {remove} {add} END')
+
+def _fill_stats_counters(c):
+    c.execute('DELETE FROM stats_counters')
+    for name, table, key, condition in STATS_COUNTERS:
+        c.execute(f'''
+            INSERT INTO stats_counters (name, key, count)
+            SELECT '{name}', {key}, COUNT(*) FROM {table} AS t
+            WHERE {_counter_condition(condition, 't')}
+            GROUP BY {key}
+        ''')
+
+def rebuild_stats_counters(conn):
+    """Recompute every summary counter from scratch"""
+    with conn:
+        _fill_stats_counters(conn.cursor())
+
+def _add_column(c, table, column, definition):
+    """Add a column unless an older version of the schema already has it"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Migrations run in order, each in its own transaction, and PRAGMA user_version records
+# how many have been applied. Databases from before versioning start at 0, so every
+# migration must also work on a schema that already has some of what it creates.
+# Append new migrations; never edit or reorder ones that have shipped.
+
+def _create_core_tables(c):
+    """Users, textbooks, password reset tokens and the activity log"""
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,8 +76,6 @@ def init_database():
             is_active BOOLEAN DEFAULT 1
         )
     ''')
-    
-    # Create textbooks table
     c.execute('''
         CREATE TABLE IF NOT EXISTS textbooks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,8 +92,6 @@ def init_database():
             FOREIGN KEY (uploaded_by) REFERENCES users (username)
         )
     ''')
-    
-    # Create password reset tokens table
     c.execute('''
         CREATE TABLE IF NOT EXISTS password_reset_tokens (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,8 +103,6 @@ def init_database():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
-    
-    # Create activity log table
     c.execute('''
         CREATE TABLE IF NOT EXISTS activity_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -70,6 +115,272 @@ def init_database():
         )
     ''')
     
+    # Databases created by the old app.init_db lack these columns
+    _add_column(c, 'textbooks', 'description', 'TEXT')
+    _add_column(c, 'textbooks', 'is_active', 'BOOLEAN DEFAULT 1')
+    for column, definition in [('first_name', 'TEXT'), ('last_name', 'TEXT'),
+                               ('last_login', 'TIMESTAMP'), ('is_active', 'BOOLEAN DEFAULT 1')]:
+        _add_column(c, 'users', column, definition)
+
+def _create_query_indexes(c):
+    """Indexes for the grade pages and activity history"""
+    # Grade pages read every active textbook of a grade in subject order
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_textbooks_grade_active_subject
+        ON textbooks (grade, is_active, subject, upload_date DESC)
+    ''')
+    
+    # Activity history is read newest first, per user and across all users
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_log_user_timestamp
+        ON activity_log (user_id, timestamp)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp
+        ON activity_log (timestamp)
+    ''')
+
+def _create_blob_store(c):
+    """Content-addressed file storage; ref_count is kept exact by triggers"""
+    _add_column(c, 'textbooks', 'sha256', 'TEXT')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_blob_insert
+        AFTER INSERT ON textbooks WHEN NEW.sha256 IS NOT NULL
+        BEGIN
+            INSERT INTO blobs (sha256, size, ref_count) VALUES (NEW.sha256, NEW.file_size, 1)
+            ON CONFLICT (sha256) DO UPDATE SET ref_count = ref_count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_blob_update
+        AFTER UPDATE OF sha256 ON textbooks WHEN OLD.sha256 IS NOT NEW.sha256
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.sha256;
+            INSERT INTO blobs (sha256, size, ref_count)
+            SELECT NEW.sha256, NEW.file_size, 1 WHERE NEW.sha256 IS NOT NULL
+            ON CONFLICT (sha256) DO UPDATE SET ref_count = ref_count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_blob_delete
+        AFTER DELETE ON textbooks WHEN OLD.sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = OLD.sha256;
+        END
+    ''')
+
+def _create_stats_counters(c):
+    """Summary counters for the statistics functions, kept in step by triggers"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT NOT NULL,
+            key NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    ''')
+    create_stats_triggers(c)
+    _fill_stats_counters(c)
+
+def _create_search_index(c):
+    """Full-text index over the catalogue, an external-content table kept in sync by triggers"""
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS textbooks_fts USING fts5(
+            original_name, description, subject, grade,
+            content = 'textbooks', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_fts_insert
+        AFTER INSERT ON textbooks
+        BEGIN
+            INSERT INTO textbooks_fts (rowid, original_name, description, subject, grade)
+            VALUES (NEW.id, NEW.original_name, NEW.description, NEW.subject, NEW.grade);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_fts_delete
+        AFTER DELETE ON textbooks
+        BEGIN
+            INSERT INTO textbooks_fts (textbooks_fts, rowid, original_name, description, subject, grade)
+            VALUES ('delete', OLD.id, OLD.original_name, OLD.description, OLD.subject, OLD.grade);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_fts_update
+        AFTER UPDATE OF original_name, description, subject, grade ON textbooks
+        BEGIN
+            INSERT INTO textbooks_fts (textbooks_fts, rowid, original_name, description, subject, grade)
+            VALUES ('delete', OLD.id, OLD.original_name, OLD.description, OLD.subject, OLD.grade);
+            INSERT INTO textbooks_fts (rowid, original_name, description, subject, grade)
+            VALUES (NEW.id, NEW.original_name, NEW.description, NEW.subject, NEW.grade);
+        END
+    ''')
+    c.execute("INSERT INTO textbooks_fts (textbooks_fts) VALUES ('rebuild')")
+
+def _create_upload_sessions(c):
+    """Resumable chunked uploads; a textbooks row is only created on finalize"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            grade INTEGER NOT NULL CHECK (grade BETWEEN 1 AND 10),
+            subject TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            created_by TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _create_catalogue_versions(c):
+    """Per-grade catalogue version, bumped by triggers on every textbook change"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS catalogue_versions (
+            grade INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_version_insert
+        AFTER INSERT ON textbooks
+        BEGIN
+            INSERT INTO catalogue_versions (grade, version) VALUES (NEW.grade, 1)
+            ON CONFLICT (grade) DO UPDATE SET version = version + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_version_update
+        AFTER UPDATE ON textbooks
+        BEGIN
+            INSERT INTO catalogue_versions (grade, version) VALUES (NEW.grade, 1)
+            ON CONFLICT (grade) DO UPDATE SET version = version + 1;
+            UPDATE catalogue_versions SET version = version + 1
+            WHERE grade = OLD.grade AND OLD.grade <> NEW.grade;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_textbooks_version_delete
+        AFTER DELETE ON textbooks
+        BEGIN
+            INSERT INTO catalogue_versions (grade, version) VALUES (OLD.grade, 1)
+            ON CONFLICT (grade) DO UPDATE SET version = version + 1;
+        END
+    ''')
+
+def _add_reclaim_columns(c):
+    """Soft-delete and checksum verification times for the storage reconciler"""
+    _add_column(c, 'textbooks', 'deleted_at', 'TIMESTAMP')
+    _add_column(c, 'blobs', 'verified_at', 'TIMESTAMP')
+    
+    # The scrubber re-verifies the blobs checked longest ago first; the reconciler purges old soft deletes
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_blobs_verified_at
+        ON blobs (verified_at)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_textbooks_deleted_at
+        ON textbooks (deleted_at) WHERE is_active = 0
+    ''')
+
+def _index_textbook_content(c):
+    """Find the textbooks sharing some content without scanning the table"""
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_textbooks_sha256
+        ON textbooks (sha256) WHERE sha256 IS NOT NULL
+    ''')
+
+def _create_sessions(c):
+    """Server-side sessions shared by every worker process"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires_at
+        ON sessions (expires_at)
+    ''')
+
+def _create_page_indexes(c):
+    """Indexes for paging through the catalogue of a grade, or of one subject in it, by id"""
+    # The id after the equality columns lets a page start at the keyset and stop after LIMIT rows
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_textbooks_grade_active_id
+        ON textbooks (grade, is_active, id)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_textbooks_grade_subject_active_id
+        ON textbooks (grade, subject, is_active, id)
+    ''')
+
+MIGRATIONS = [
+    _create_core_tables,
+    _create_query_indexes,
+    _create_blob_store,
+    _create_stats_counters,
+    _create_search_index,
+    _create_upload_sessions,
+    _create_catalogue_versions,
+    _add_reclaim_columns,
+    _index_textbook_content,
+    _create_sessions,
+    _create_page_indexes,
+]
+
+def get_schema_version(conn):
+    """Get the number of migrations applied to a database"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """Apply pending migrations; returns how many ran, and costs one pragma read when current"""
+    version = get_schema_version(conn)
+    if version >= len(MIGRATIONS):
+        return 0
+    
+    applied = 0
+    c = conn.cursor()
+    for number, migration in enumerate(MIGRATIONS, 1):
+        if number <= version:
+            continue
+        # IMMEDIATE takes the write lock up front, so workers starting together migrate one at a time
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            migration(c)
+            c.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied += 1
+    return applied
+
+def init_database():
+    """Initialize the SQLite database with tables and sample data"""
+    
+    # Get the shared database connection
+    conn = get_connection()
+    c = conn.cursor()
+    
+    migrate(conn)
+    
     # Insert default admin user
     admin_hash = generate_password_hash('admin123')
     try:
@@ -127,9 +438,8 @@ def init_database():
     
     print(f"✓ Sample textbooks added to database")
     
-    # Commit changes and close connection
+    # Commit changes
     conn.commit()
-    conn.close()
     
     print("✓ Database initialized successfully!")
     print("✓ Database file: school.db")
@@ -137,30 +447,20 @@ def init_database():
 
 def get_database_stats():
     """Get statistics about the database"""
-    conn = sqlite3.connect('school.db')
+    conn = get_connection()
     c = conn.cursor()
     
-    # Count users
-    c.execute("SELECT COUNT(*) FROM users WHERE user_type = 'admin'")
-    admin_count = c.fetchone()[0]
+    # Read from the trigger-maintained counters instead of scanning tables
+    c.execute("SELECT key, count FROM stats_counters WHERE name = 'users_by_type'")
+    users_by_type = dict(c.fetchall())
     
-    c.execute("SELECT COUNT(*) FROM users WHERE user_type = 'student'")
-    student_count = c.fetchone()[0]
-    
-    # Count textbooks
-    c.execute("SELECT COUNT(*) FROM textbooks")
-    textbook_count = c.fetchone()[0]
-    
-    # Count textbooks by grade
-    c.execute("SELECT grade, COUNT(*) FROM textbooks GROUP BY grade ORDER BY grade")
+    c.execute("SELECT key, count FROM stats_counters WHERE name = 'textbooks_by_grade' AND count > 0 ORDER BY key")
     grade_stats = c.fetchall()
     
-    conn.close()
-    
     return {
-        'admin_count': admin_count,
-        'student_count': student_count,
-        'textbook_count': textbook_count,
+        'admin_count': users_by_type.get('admin', 0),
+        'student_count': users_by_type.get('student', 0),
+        'textbook_count': sum(count for _, count in grade_stats),
         'grade_stats': grade_stats
     }
 
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+
+import metrics
+
+# Connection settings shared by app.py, models.py and database.py
+DATABASE = 'school.db'
+BUSY_TIMEOUT = 5.0                    # seconds to wait on a locked database
+MMAP_SIZE = 256 * 1024 * 1024         # 256MB memory-mapped I/O
+CACHE_SIZE = -16000                   # page cache in KiB (negative = KiB)
+STATEMENT_CACHE = 256                 # prepared statements kept per connection
+POOL_SIZE = 16                        # idle connections kept for reuse
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_idle = []
+
+
+def configure(database=None, busy_timeout=None, mmap_size=None, pool_size=None):
+    """Change connection settings; existing connections are closed"""
+    global DATABASE, BUSY_TIMEOUT, MMAP_SIZE, POOL_SIZE
+    if database is not None:
+        DATABASE = database
+    if busy_timeout is not None:
+        BUSY_TIMEOUT = busy_timeout
+    if mmap_size is not None:
+        MMAP_SIZE = mmap_size
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    close_all()
+
+
+def connect(database=None):
+    """Open a new connection configured for concurrent readers and one writer"""
+    conn = sqlite3.connect(database or DATABASE, timeout=BUSY_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE,
+                           check_same_thread=False, factory=metrics.TimedConnection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size={CACHE_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+def _usable(entry):
+    """A pooled connection is only reused in the process and database it was opened for"""
+    return entry[1] == os.getpid() and entry[2] == DATABASE
+
+
+def get_connection():
+    """Get the connection bound to the current thread, borrowing one from the pool if needed"""
+    entry = getattr(_local, 'entry', None)
+    if entry is not None and _usable(entry):
+        return entry[0]
+    if entry is not None and entry[1] == os.getpid():
+        entry[0].close()
+
+    _local.entry = None
+    with _pool_lock:
+        while _idle:
+            candidate = _idle.pop()
+            if _usable(candidate):
+                entry = candidate
+                break
+            if candidate[1] == os.getpid():
+                candidate[0].close()
+        else:
+            entry = None
+
+    if entry is None:
+        entry = (connect(), os.getpid(), DATABASE)
+    _local.entry = entry
+    return entry[0]
+
+
+def release_connection():
+    """Return the current thread's connection to the pool"""
+    entry = getattr(_local, 'entry', None)
+    _local.entry = None
+    if entry is None or entry[1] != os.getpid():
+        return
+
+    conn = entry[0]
+    if conn.in_transaction:
+        conn.rollback()
+
+    with _pool_lock:
+        if _usable(entry) and len(_idle) < POOL_SIZE:
+            _idle.append(entry)
+            return
+    conn.close()
+
+
+def close_all():
+    """Close the current thread's connection and every idle pooled connection"""
+    entry = getattr(_local, 'entry', None)
+    _local.entry = None
+    with _pool_lock:
+        idle = list(_idle)
+        _idle.clear()
+    if entry is not None:
+        idle.append(entry)
+
+    for conn, pid, _ in idle:
+        # Connections inherited across fork() belong to the parent
+        if pid == os.getpid():
+            conn.close()
+
+
+def init_app(app):
+    """Hand connections back to the pool when each request finishes"""
+    configure(database=app.config.get('DATABASE', DATABASE))
+
+    @app.teardown_appcontext
+    def _release_db_connection(exception=None):
+        release_connection()
@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import os
+import re
+import shutil
+import time
+
+from werkzeug.utils import secure_filename
+
+from db import get_connection
+from models import User, ActivityLog, get_grades, get_subjects
+import storage
+
+GRADE_FOLDER = re.compile(r'^grade_(\d+)$')
+
+
+class ImportEntry:
+    """A file to import and where it belongs in the catalogue"""
+
+    def __init__(self, path, grade, subject, original_name=None, description=None):
+        self.path = path
+        self.grade = grade
+        self.subject = subject
+        self.original_name = original_name or os.path.basename(path)
+        self.description = description
+        self.sha256 = None
+        self.size = None
+        self.error = None
+
+
+def walk_directory(source):
+    """Find files laid out as <source>/grade_N/<Subject>/<file>, like create_sample_uploads_structure"""
+    entries = []
+    for grade_dir in sorted(os.listdir(source)):
+        match = GRADE_FOLDER.match(grade_dir)
+        if not match or not os.path.isdir(os.path.join(source, grade_dir)):
+            continue
+        for subject in sorted(os.listdir(os.path.join(source, grade_dir))):
+            subject_dir = os.path.join(source, grade_dir, subject)
+            if not os.path.isdir(subject_dir):
+                continue
+            for root, _, files in os.walk(subject_dir):
+                for name in sorted(files):
+                    entries.append(ImportEntry(os.path.join(root, name), int(match.group(1)), subject))
+    return entries
+
+
+def read_manifest(manifest_path):
+    """Read a CSV manifest with path, grade and subject columns (original_name and description optional)"""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    with open(manifest_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            path = row['path']
+            if not os.path.isabs(path):
+                path = os.path.join(base, path)
+            try:
+                grade = int(row['grade'])
+            except (TypeError, ValueError):
+                grade = None
+            entries.append(ImportEntry(path, grade, row.get('subject'),
+                                       row.get('original_name') or None, row.get('description') or None))
+    return entries
+
+
+def _validate(entry, allowed_extensions):
+    name = entry.original_name
+    if '.' not in name or name.rsplit('.', 1)[1].lower() not in allowed_extensions:
+        return 'file type not allowed'
+    if entry.grade not in get_grades():
+        return 'unknown grade'
+    if entry.subject not in get_subjects():
+        return 'unknown subject'
+    if not os.path.isfile(entry.path):
+        return 'file not found'
+    return None
+
+
+def _ingest(entry, dry_run):
+    """Hash and stat a file, then copy it into the blob store unless its content is already there"""
+    try:
+        entry.sha256, entry.size = storage.hash_file(entry.path)
+        if not dry_run and not storage.exists(entry.sha256):
+            staged = storage.staging_path()
+            shutil.copyfile(entry.path, staged)
+            storage.store_file(staged, entry.sha256)
+    except OSError as e:
+        entry.error = str(e)
+    return entry
+
+
+def import_textbooks(entries, uploaded_by, allowed_extensions, dry_run=False, workers=8, progress=None):
+    """Import files into storage and insert every textbook row in one transaction
+
+    progress, if given, is called with (done, total, bytes_done) as files
+    finish. Returns a report dict with counts and throughput.
+    """
+    started = time.monotonic()
+    valid, skipped = [], []
+    for entry in entries:
+        entry.error = _validate(entry, allowed_extensions)
+        (skipped if entry.error else valid).append(entry)
+
+    done, bytes_done = 0, 0
+    imported = []
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(_ingest, entry, dry_run) for entry in valid]
+        for future in as_completed(futures):
+            entry = future.result()
+            if entry.error:
+                skipped.append(entry)
+            else:
+                imported.append(entry)
+                bytes_done += entry.size
+            done += 1
+            if progress:
+                progress(done, len(valid), bytes_done)
+
+    if not dry_run and imported:
+        rows = []
+        for entry in imported:
+            file_type = entry.original_name.rsplit('.', 1)[1].lower()
+            # Only the stored name is sanitised; the catalogue shows the name as given
+            filename = secure_filename(entry.original_name) or f'textbook.{file_type}'
+            rows.append((filename, entry.original_name, entry.grade, entry.subject, file_type,
+                         entry.size, uploaded_by, entry.description, entry.sha256))
+        conn = get_connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO textbooks (filename, original_name, grade, subject, file_type,
+                                     file_size, uploaded_by, description, sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+        user = User.get_by_username(uploaded_by)
+        if user:
+            ActivityLog.log_activity(user.id, 'TEXTBOOKS_IMPORTED', f'Imported {len(rows)} textbooks')
+
+    elapsed = time.monotonic() - started
+    return {
+        'imported': len(imported),
+        'skipped': [(entry.path, entry.error) for entry in skipped],
+        'bytes': bytes_done,
+        'unique_files': len({entry.sha256 for entry in imported}),
+        'seconds': elapsed,
+        'files_per_second': len(imported) / elapsed if elapsed else 0.0,
+        'mb_per_second': bytes_done / (1024 * 1024) / elapsed if elapsed else 0.0,
+        'dry_run': dry_run
+    }
@@ -0,0 +1,443 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the development server there is a single process
+    fcntl = None
+
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SLOW_REQUEST_SECONDS = 0.5
+MAX_RECORDED_QUERIES = 200   # statements kept per request for the slow-request log
+FLUSH_INTERVAL = 1.0         # seconds between writes of a process's metrics to METRICS_FOLDER
+WHITESPACE = re.compile(r'\s+')
+EXITED = 'exited.json'       # counters of worker processes that are gone
+
+_registry = []
+_local = threading.local()
+_folder = None
+_flusher_pid = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with one value per label set"""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def collect(self):
+        with self._lock:
+            return {'type': 'counter', 'help': self.help, 'series': dict(self._values)}
+
+
+class Histogram:
+    """Histogram with fixed bucket bounds and one series per label set"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def collect(self):
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        return {'type': 'histogram', 'help': self.help, 'buckets': self.buckets, 'series': series}
+
+
+class Gauge:
+    """Value read from a callback at scrape time, such as the size of a cache
+
+    kind='counter' exports a count kept by another object as a counter, so
+    it keeps adding up after the process that counted it has exited.
+    """
+
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        _registry.append(self)
+
+    def collect(self):
+        return {'type': self.kind, 'help': self.help, 'series': {(): self.read()}}
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Time spent handling requests', LATENCY_BUCKETS)
+requests_total = Counter('http_requests_total', 'Requests handled, by status code')
+request_sql_queries = Histogram('http_request_sql_queries', 'SQL statements run per request', QUERY_COUNT_BUCKETS)
+request_sql_seconds = Histogram('http_request_sql_seconds', 'Time spent in SQL per request', LATENCY_BUCKETS)
+slow_requests = Counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS')
+sql_queries = Counter('sqlite_queries_total', 'SQL statements run, including background threads')
+sql_seconds = Counter('sqlite_query_seconds_total', 'Time spent running SQL statements and fetching rows')
+upload_bytes = Counter('textbook_upload_bytes_total', 'Bytes of textbook files received')
+download_bytes = Counter('textbook_download_bytes_total', 'Bytes of textbook files sent or handed to the proxy')
+
+
+def _render_metric(name, metric):
+    lines = [f'# HELP {name} {metric["help"]}', f'# TYPE {name} {metric["type"]}']
+    if metric['type'] != 'histogram':
+        for labels, value in sorted(metric['series'].items()):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return lines
+
+    for labels, series in sorted(metric['series'].items()):
+        cumulative = 0
+        for bound, count in zip(tuple(metric['buckets']) + ('+Inf',), series):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {series[-1]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return lines
+
+
+def snapshot():
+    """Get the current value of every metric of this process"""
+    return {metric.name: metric.collect() for metric in _registry}
+
+
+def _merge(total, metrics, gauges=True):
+    """Add one process's metrics into total; gauges of exited processes are left out"""
+    for name, metric in metrics.items():
+        if not gauges and metric['type'] == 'gauge':
+            continue
+        merged = total.setdefault(name, dict(metric, series={}))
+        for labels, value in metric['series'].items():
+            current = merged['series'].get(labels)
+            if current is None:
+                merged['series'][labels] = value
+            elif metric['type'] == 'histogram':
+                merged['series'][labels] = [a + b for a, b in zip(current, value)]
+            else:
+                merged['series'][labels] = current + value
+    return total
+
+
+def _dump(metrics):
+    return {name: dict(metric, series=[[list(labels), value] for labels, value in metric['series'].items()])
+            for name, metric in metrics.items()}
+
+
+def _load(path):
+    """Read metrics written by _write, or None if the file is gone"""
+    try:
+        with open(path) as f:
+            dumped = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {name: dict(metric, series={tuple(tuple(pair) for pair in labels): value
+                                       for labels, value in metric['series']})
+            for name, metric in dumped.items()}
+
+
+def _write(path, metrics):
+    # Written aside and renamed, so a scrape never reads half a file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(_dump(metrics), f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _folder_lock():
+    with open(os.path.join(_folder, '.lock'), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def flush():
+    """Write this process's metrics to METRICS_FOLDER, where the other workers' scrapes read them"""
+    if _folder is not None:
+        _write(os.path.join(_folder, f'{os.getpid()}.json'), snapshot())
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            logger.exception('Could not write metrics to %s', _folder)
+
+
+def _start_flusher():
+    """Flush from a daemon thread in every process that records metrics, so idle workers stay current"""
+    global _flusher_pid
+    if _folder is None or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+
+
+def collect():
+    """Get the metrics of every worker process, or of this one when there is no METRICS_FOLDER
+
+    Files of exited workers are folded into one, so their counts keep
+    adding up (as counters must) without the folder growing as gunicorn
+    recycles workers.
+    """
+    total = _merge({}, snapshot())
+    if _folder is None:
+        return total
+
+    flush()
+    own = f'{os.getpid()}.json'
+    with _folder_lock():
+        exited = _load(os.path.join(_folder, EXITED)) or {}
+        folded = False
+        for name in os.listdir(_folder):
+            pid, ext = os.path.splitext(name)
+            if ext != '.json' or not pid.isdigit() or name == own:
+                continue
+            metrics = _load(os.path.join(_folder, name))
+            if metrics is None:
+                continue
+            if _alive(int(pid)):
+                _merge(total, metrics)
+            else:
+                _merge(exited, metrics, gauges=False)
+                os.remove(os.path.join(_folder, name))
+                folded = True
+        if folded:
+            _write(os.path.join(_folder, EXITED), exited)
+    return _merge(total, exited)
+
+
+def render():
+    """Get every metric in the Prometheus text exposition format"""
+    lines = []
+    for name, metric in collect().items():
+        lines.extend(_render_metric(name, metric))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Zero the counts a worker inherited from the master when it was forked"""
+    for metric in _registry:
+        if hasattr(metric, 'reset'):
+            metric.reset()
+
+
+def clear():
+    """Forget the metrics of earlier runs; called by the server before any worker starts"""
+    if _folder is None:
+        return
+    os.makedirs(_folder, exist_ok=True)
+    for name in os.listdir(_folder):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(_folder, name))
+
+
+class RequestQueries:
+    """SQL statements run by the current request"""
+
+    __slots__ = ('count', 'seconds', 'queries')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = []
+
+
+def _record(sql, elapsed, new_statement=True):
+    if new_statement:
+        sql_queries.inc()
+    sql_seconds.inc(elapsed)
+
+    current = getattr(_local, 'request', None)
+    if current is None:
+        return
+    current.seconds += elapsed
+    if new_statement:
+        current.count += 1
+        if len(current.queries) < MAX_RECORDED_QUERIES:
+            current.queries.append([sql, elapsed])
+    elif current.queries:
+        # Time spent fetching rows belongs to the statement that produced them
+        current.queries[-1][1] += elapsed
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that accounts the time of every statement and fetch"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record(sql_script, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _record(None, time.perf_counter() - started, new_statement=False)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _record(None, time.perf_counter() - started, new_statement=False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record(None, time.perf_counter() - started, new_statement=False)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those behind conn.execute(), are TimedCursors
+
+    Timing wraps the calls rather than using set_trace_callback, which only
+    reports statement starts and passes SQL with its parameters filled in,
+    so password hashes and tokens would end up in the slow-request log.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def _log_slow_request(endpoint, elapsed, current):
+    lines = [f'Slow request {request.method} {request.full_path.rstrip("?")} ({endpoint}) took '
+             f'{elapsed * 1000:.1f} ms with {current.count} queries ({current.seconds * 1000:.1f} ms SQL)']
+    for sql, seconds in current.queries:
+        sql = WHITESPACE.sub(' ', sql).strip()[:300]
+        lines.append(f'  {seconds * 1000:8.2f} ms  {sql}')
+    if current.count > len(current.queries):
+        lines.append(f'  ... {current.count - len(current.queries)} more')
+    logger.warning('\n'.join(lines))
+
+
+def init_app(app):
+    """Time every request and its SQL, and serve the results of every worker process at /metrics"""
+    global _folder
+    app.config.setdefault('SLOW_REQUEST_SECONDS', SLOW_REQUEST_SECONDS)
+    app.config.setdefault('METRICS_FOLDER', None)
+    _folder = app.config['METRICS_FOLDER']
+    if _folder is not None:
+        # The flush thread writes there for the life of the process, whatever the working directory
+        _folder = os.path.abspath(_folder)
+        os.makedirs(_folder, exist_ok=True)
+
+    @app.before_request
+    def _start_request_metrics():
+        _local.request = RequestQueries()
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        current = getattr(_local, 'request', None)
+        if started is None or current is None:
+            return response
+        _start_flusher()
+
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        request_duration.observe(elapsed, endpoint=endpoint, method=request.method)
+        requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        request_sql_queries.observe(current.count, endpoint=endpoint)
+        request_sql_seconds.observe(current.seconds, endpoint=endpoint)
+
+        if elapsed >= app.config['SLOW_REQUEST_SECONDS']:
+            slow_requests.inc(endpoint=endpoint)
+            _log_slow_request(endpoint, elapsed, current)
+        return response
+
+    @app.teardown_request
+    def _finish_request_metrics(exception=None):
+        _local.request = None
+
+    def metrics_view():
+        return app.response_class(render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
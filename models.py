@@ -1,11 +1,34 @@
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import secrets
+import re
+
+from db import get_connection
+from batch_writer import BatchWriter
+import passwords
+
+# Rows fetched per round trip by the iter_* methods. Models are slotted, so
+# instances carry no __dict__ and large result sets stay compact.
+ITER_BATCH_SIZE = 500
+
+# Shorter last words in a search match whole words only, since a one-letter prefix matches nearly everything
+SEARCH_MIN_PREFIX = 3
+# Names weigh most in search ranking, then descriptions, subjects and grades
+SEARCH_RANK = 'bm25(10.0, 4.0, 2.0, 1.0)'
+
+def iter_rows(cursor, batch_size=ITER_BATCH_SIZE):
+    """Yield rows from an executed cursor, fetching batch_size at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
 
 class User:
     """User model for handling admin and student users"""
     
+    __slots__ = ('id', 'username', 'email', 'password_hash', 'user_type', 'first_name', 'last_name', 'created_at', 'last_login', 'is_active')
+    
     def __init__(self, id=None, username=None, email=None, password_hash=None, 
                  user_type=None, first_name=None, last_name=None, 
                  created_at=None, last_login=None, is_active=True):
@@ -23,33 +46,31 @@ class User:
     @staticmethod
     def create_user(username, email, password, user_type, first_name=None, last_name=None):
         """Create a new user"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        password_hash = generate_password_hash(password)
+        password_hash = passwords.hasher.hash(password)
         
         try:
-            c.execute('''
-                INSERT INTO users (username, email, password_hash, user_type, first_name, last_name)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (username, email, password_hash, user_type, first_name, last_name))
+            with conn:
+                c.execute('''
+                    INSERT INTO users (username, email, password_hash, user_type, first_name, last_name)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (username, email, password_hash, user_type, first_name, last_name))
             
             user_id = c.lastrowid
-            conn.commit()
             
             # Log the activity
             ActivityLog.log_activity(user_id, 'USER_CREATED', f'User {username} created with type {user_type}')
             
-            conn.close()
             return user_id
         except sqlite3.IntegrityError as e:
-            conn.close()
             raise ValueError(f"User creation failed: {str(e)}")
     
     @staticmethod
     def authenticate(username, password, user_type):
-        """Authenticate user login"""
-        conn = sqlite3.connect('school.db')
+        """Authenticate user login; raises passwords.HashingBusy when the hashing pool is saturated"""
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
@@ -61,26 +82,32 @@ class User:
         
         user_data = c.fetchone()
         
-        if user_data and check_password_hash(user_data[3], password):
+        if user_data and passwords.hasher.verify(user_data[3], password):
+            user = User(*user_data)
+            
+            # Upgrade hashes made with outdated parameters while we have the password
+            if passwords.hasher.needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = passwords.hasher.hash(password)
+                except passwords.HashingBusy:
+                    pass  # Try again on a later login
+            
             # Update last login
-            c.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user_data[0],))
-            conn.commit()
+            with conn:
+                c.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP, password_hash = ? WHERE id = ?',
+                          (user.password_hash, user.id))
             
             # Log the activity
             ActivityLog.log_activity(user_data[0], 'LOGIN', f'User {username} logged in')
             
-            conn.close()
-            
-            # Return User object
-            return User(*user_data)
+            return user
         
-        conn.close()
         return None
     
     @staticmethod
     def get_by_id(user_id):
         """Get user by ID"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
@@ -90,7 +117,6 @@ class User:
         ''', (user_id,))
         
         user_data = c.fetchone()
-        conn.close()
         
         if user_data:
             return User(*user_data)
@@ -99,7 +125,7 @@ class User:
     @staticmethod
     def get_by_username(username):
         """Get user by username"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
@@ -109,7 +135,6 @@ class User:
         ''', (username,))
         
         user_data = c.fetchone()
-        conn.close()
         
         if user_data:
             return User(*user_data)
@@ -118,7 +143,7 @@ class User:
     @staticmethod
     def get_by_email(email):
         """Get user by email"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
@@ -128,7 +153,6 @@ class User:
         ''', (email,))
         
         user_data = c.fetchone()
-        conn.close()
         
         if user_data:
             return User(*user_data)
@@ -136,17 +160,16 @@ class User:
     
     def update_password(self, new_password):
         """Update user password"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        new_hash = generate_password_hash(new_password)
-        c.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, self.id))
-        conn.commit()
+        new_hash = passwords.hasher.hash(new_password)
+        with conn:
+            c.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, self.id))
         
         # Log the activity
         ActivityLog.log_activity(self.id, 'PASSWORD_CHANGED', 'User changed password')
         
-        conn.close()
         self.password_hash = new_hash
     
     def is_admin(self):
@@ -186,9 +209,11 @@ class User:
 class Textbook:
     """Textbook model for managing educational materials"""
     
+    __slots__ = ('id', 'filename', 'original_name', 'grade', 'subject', 'file_type', 'file_size', 'uploaded_by', 'upload_date', 'description', 'is_active', 'sha256')
+    
     def __init__(self, id=None, filename=None, original_name=None, grade=None, 
                  subject=None, file_type=None, file_size=None, uploaded_by=None, 
-                 upload_date=None, description=None, is_active=True):
+                 upload_date=None, description=None, is_active=True, sha256=None):
         self.id = id
         self.filename = filename
         self.original_name = original_name
@@ -200,22 +225,23 @@ class Textbook:
         self.upload_date = upload_date
         self.description = description
         self.is_active = is_active
+        self.sha256 = sha256
     
     @staticmethod
     def create_textbook(filename, original_name, grade, subject, file_type, 
-                       file_size, uploaded_by, description=None):
+                       file_size, uploaded_by, description=None, sha256=None):
         """Create a new textbook entry"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        c.execute('''
-            INSERT INTO textbooks (filename, original_name, grade, subject, file_type, 
-                                 file_size, uploaded_by, description)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (filename, original_name, grade, subject, file_type, file_size, uploaded_by, description))
+        with conn:
+            c.execute('''
+                INSERT INTO textbooks (filename, original_name, grade, subject, file_type, 
+                                     file_size, uploaded_by, description, sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (filename, original_name, grade, subject, file_type, file_size, uploaded_by, description, sha256))
         
         textbook_id = c.lastrowid
-        conn.commit()
         
         # Log the activity
         user = User.get_by_username(uploaded_by)
@@ -223,18 +249,17 @@ class Textbook:
             ActivityLog.log_activity(user.id, 'TEXTBOOK_UPLOADED', 
                                    f'Uploaded {original_name} for Grade {grade} - {subject}')
         
-        conn.close()
         return textbook_id
     
     @staticmethod
     def get_by_grade_and_subject(grade, subject):
         """Get textbooks by grade and subject"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
             SELECT id, filename, original_name, grade, subject, file_type, 
-                   file_size, uploaded_by, upload_date, description, is_active
+                   file_size, uploaded_by, upload_date, description, is_active, sha256
             FROM textbooks 
             WHERE grade = ? AND subject = ? AND is_active = 1
             ORDER BY upload_date DESC
@@ -244,23 +269,21 @@ class Textbook:
         for row in c.fetchall():
             textbooks.append(Textbook(*row))
         
-        conn.close()
         return textbooks
     
     @staticmethod
     def get_by_id(textbook_id):
         """Get textbook by ID"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
             SELECT id, filename, original_name, grade, subject, file_type, 
-                   file_size, uploaded_by, upload_date, description, is_active
+                   file_size, uploaded_by, upload_date, description, is_active, sha256
             FROM textbooks WHERE id = ?
         ''', (textbook_id,))
         
         textbook_data = c.fetchone()
-        conn.close()
         
         if textbook_data:
             return Textbook(*textbook_data)
@@ -269,31 +292,115 @@ class Textbook:
     @staticmethod
     def get_all_by_grade(grade):
         """Get all textbooks for a specific grade"""
-        conn = sqlite3.connect('school.db')
+        return list(Textbook.iter_all_by_grade(grade))
+    
+    @staticmethod
+    def iter_all_by_grade(grade):
+        """Stream all textbooks for a specific grade without loading them all at once"""
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
             SELECT id, filename, original_name, grade, subject, file_type, 
-                   file_size, uploaded_by, upload_date, description, is_active
+                   file_size, uploaded_by, upload_date, description, is_active, sha256
             FROM textbooks 
             WHERE grade = ? AND is_active = 1
             ORDER BY subject, upload_date DESC
         ''', (grade,))
         
-        textbooks = []
-        for row in c.fetchall():
-            textbooks.append(Textbook(*row))
+        for row in iter_rows(c):
+            yield Textbook(*row)
+    
+    @staticmethod
+    def get_page(grade=None, subject=None, file_type=None, after=None, limit=50):
+        """Get active textbooks in id order, starting after the id given as after
+        
+        Keyset pagination: pass the id of the last textbook returned to get
+        the next page, which costs the same however deep it is.
+        """
+        filters = ''
+        params = []
+        for column, value in [('grade', grade), ('subject', subject), ('file_type', file_type)]:
+            if value is not None:
+                filters += f' AND {column} = ?'
+                params.append(value)
+        if after is not None:
+            filters += ' AND id > ?'
+            params.append(after)
+        params.append(limit)
+        
+        conn = get_connection()
+        c = conn.cursor()
         
-        conn.close()
-        return textbooks
+        c.execute(f'''
+            SELECT id, filename, original_name, grade, subject, file_type, 
+                   file_size, uploaded_by, upload_date, description, is_active, sha256
+            FROM textbooks 
+            WHERE is_active = 1{filters}
+            ORDER BY id
+            LIMIT ?
+        ''', params)
+        
+        return [Textbook(*row) for row in c.fetchall()]
+    
+    @staticmethod
+    def search(query, grade=None, subject=None, file_type=None, limit=20, offset=0):
+        """Full-text search active textbooks, best matches first
+        
+        Returns (textbook, snippet) pairs; matched terms in the snippet are
+        wrapped in \x02 and \x03 so callers can escape the text before
+        highlighting them.
+        """
+        # Quote every word so user input can't form FTS5 syntax; the last one matches as a prefix
+        words = re.findall(r'\w+', query or '')
+        if not words:
+            return []
+        match = ' '.join(f'"{word}"' for word in words)
+        if len(words[-1]) >= SEARCH_MIN_PREFIX:
+            match += '*'
+        
+        # Grade and subject are indexed columns too, so filtering on them narrows the candidates
+        if grade is not None:
+            match += f' AND grade : "{int(grade)}"'
+        if subject is not None:
+            subject_words = re.findall(r'\w+', subject)
+            if subject_words:
+                match += ' AND subject : "' + ' '.join(subject_words) + '"'
+        
+        filters = ''
+        params = [match, SEARCH_RANK]
+        for column, value in [('grade', grade), ('subject', subject), ('file_type', file_type)]:
+            if value is not None:
+                filters += f' AND t.{column} = ?'
+                params.append(value)
+        params += [limit, offset]
+        
+        conn = get_connection()
+        c = conn.cursor()
+        
+        # ORDER BY rank lets FTS5 hand back matches best first, so filtered-out rows are skipped during
+        # the scan and snippets are only built for the page returned
+        c.execute(f'''
+            SELECT t.id, t.filename, t.original_name, t.grade, t.subject, t.file_type, 
+                   t.file_size, t.uploaded_by, t.upload_date, t.description, t.is_active, t.sha256,
+                   snippet(textbooks_fts, -1, char(2), char(3), '…', 12)
+            FROM textbooks_fts
+            JOIN textbooks t ON t.id = textbooks_fts.rowid
+            WHERE textbooks_fts MATCH ? AND textbooks_fts.rank MATCH ? AND t.is_active = 1{filters}
+            ORDER BY textbooks_fts.rank
+            LIMIT ? OFFSET ?
+        ''', params)
+        
+        return [(Textbook(*row[:12]), row[12]) for row in c.fetchall()]
     
     def delete(self):
         """Soft delete textbook"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        c.execute('UPDATE textbooks SET is_active = 0 WHERE id = ?', (self.id,))
-        conn.commit()
+        with conn:
+            # The reconciler removes the row and its file once deleted_at is past the grace period
+            c.execute('UPDATE textbooks SET is_active = 0, deleted_at = CURRENT_TIMESTAMP WHERE id = ?', (self.id,))
         
         # Log the activity
         user = User.get_by_username(self.uploaded_by)
@@ -301,7 +408,6 @@ class Textbook:
             ActivityLog.log_activity(user.id, 'TEXTBOOK_DELETED', 
                                    f'Deleted {self.original_name} for Grade {self.grade} - {self.subject}')
         
-        conn.close()
         self.is_active = False
     
     def get_file_size_formatted(self):
@@ -329,12 +435,194 @@ class Textbook:
             'uploaded_by': self.uploaded_by,
             'upload_date': self.upload_date,
             'description': self.description,
-            'is_active': self.is_active
+            'is_active': self.is_active,
+            'sha256': self.sha256
+        }
+
+class UploadSession:
+    """Resumable chunked upload that becomes a textbook once finalized"""
+    
+    __slots__ = ('id', 'filename', 'original_name', 'grade', 'subject', 'file_type', 'total_size', 'received', 'created_by', 'created_at', 'updated_at')
+    
+    def __init__(self, id=None, filename=None, original_name=None, grade=None, 
+                 subject=None, file_type=None, total_size=None, received=0, 
+                 created_by=None, created_at=None, updated_at=None):
+        self.id = id
+        self.filename = filename
+        self.original_name = original_name
+        self.grade = grade
+        self.subject = subject
+        self.file_type = file_type
+        self.total_size = total_size
+        self.received = received
+        self.created_by = created_by
+        self.created_at = created_at
+        self.updated_at = updated_at
+    
+    @staticmethod
+    def create(filename, original_name, grade, subject, file_type, total_size, created_by):
+        """Start a new upload session"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        upload_id = secrets.token_urlsafe(16)
+        with conn:
+            c.execute('''
+                INSERT INTO upload_sessions (id, filename, original_name, grade, subject, 
+                                             file_type, total_size, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (upload_id, filename, original_name, grade, subject, file_type, total_size, created_by))
+        
+        return UploadSession.get_by_id(upload_id)
+    
+    @staticmethod
+    def get_by_id(upload_id):
+        """Get upload session by ID"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT id, filename, original_name, grade, subject, file_type, 
+                   total_size, received, created_by, created_at, updated_at
+            FROM upload_sessions WHERE id = ?
+        ''', (upload_id,))
+        
+        session_data = c.fetchone()
+        
+        if session_data:
+            return UploadSession(*session_data)
+        return None
+    
+    def advance(self, received):
+        """Record bytes received; fails if another request moved the offset first"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        with conn:
+            c.execute('''
+                UPDATE upload_sessions SET received = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND received = ?
+            ''', (received, self.id, self.received))
+        
+        if c.rowcount != 1:
+            return False
+        self.received = received
+        return True
+    
+    def is_complete(self):
+        """Check if every byte has been received"""
+        return self.received == self.total_size
+    
+    def finalize(self, sha256, description=None):
+        """Create the textbook row and close the session in one transaction; None if already finalized"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        with conn:
+            # Claim the session first so a repeated finalize can't add a second row
+            c.execute('DELETE FROM upload_sessions WHERE id = ?', (self.id,))
+            if c.rowcount != 1:
+                return None
+            c.execute('''
+                INSERT INTO textbooks (filename, original_name, grade, subject, file_type, 
+                                     file_size, uploaded_by, description, sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (self.filename, self.original_name, self.grade, self.subject, self.file_type,
+                  self.total_size, self.created_by, description, sha256))
+            textbook_id = c.lastrowid
+        
+        # Log the activity
+        user = User.get_by_username(self.created_by)
+        if user:
+            ActivityLog.log_activity(user.id, 'TEXTBOOK_UPLOADED', 
+                                   f'Uploaded {self.original_name} for Grade {self.grade} - {self.subject}')
+        
+        return textbook_id
+    
+    def delete(self):
+        """Abandon the upload session"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        with conn:
+            c.execute('DELETE FROM upload_sessions WHERE id = ?', (self.id,))
+    
+    def to_dict(self):
+        """Convert upload session to dictionary"""
+        return {
+            'upload_id': self.id,
+            'original_name': self.original_name,
+            'grade': self.grade,
+            'subject': self.subject,
+            'file_type': self.file_type,
+            'total_size': self.total_size,
+            'offset': self.received,
+            'complete': self.is_complete()
         }
 
+class Blob:
+    """Stored file content shared by every textbook with the same SHA-256"""
+    
+    __slots__ = ('sha256', 'size', 'ref_count', 'created_at')
+    
+    def __init__(self, sha256=None, size=None, ref_count=0, created_at=None):
+        self.sha256 = sha256
+        self.size = size
+        self.ref_count = ref_count
+        self.created_at = created_at
+    
+    @staticmethod
+    def get_by_sha256(sha256):
+        """Get blob by content hash"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT sha256, size, ref_count, created_at
+            FROM blobs WHERE sha256 = ?
+        ''', (sha256,))
+        
+        blob_data = c.fetchone()
+        
+        if blob_data:
+            return Blob(*blob_data)
+        return None
+    
+    @staticmethod
+    def delete_if_unreferenced(sha256):
+        """Forget a blob no textbook points at; True if its file should be removed"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        with conn:
+            c.execute('DELETE FROM blobs WHERE sha256 = ? AND ref_count <= 0', (sha256,))
+        
+        return c.rowcount == 1
+    
+    @staticmethod
+    def rebuild_ref_counts():
+        """Recompute every reference count from the textbooks table"""
+        conn = get_connection()
+        c = conn.cursor()
+        
+        with conn:
+            c.execute('''
+                INSERT INTO blobs (sha256, size, ref_count)
+                SELECT sha256, MAX(file_size), COUNT(*)
+                FROM textbooks WHERE sha256 IS NOT NULL
+                GROUP BY sha256
+                ON CONFLICT (sha256) DO UPDATE SET ref_count = excluded.ref_count
+            ''')
+            c.execute('''
+                UPDATE blobs SET ref_count = 0
+                WHERE sha256 NOT IN (SELECT sha256 FROM textbooks WHERE sha256 IS NOT NULL)
+            ''')
+
 class PasswordResetToken:
     """Password reset token model"""
     
+    __slots__ = ('id', 'user_id', 'token', 'created_at', 'expires_at', 'used')
+    
     def __init__(self, id=None, user_id=None, token=None, created_at=None, 
                  expires_at=None, used=False):
         self.id = id
@@ -347,30 +635,29 @@ class PasswordResetToken:
     @staticmethod
     def create_token(user_id, expires_in_hours=24):
         """Create a password reset token"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         token = secrets.token_urlsafe(32)
         expires_at = datetime.now() + timedelta(hours=expires_in_hours)
         
-        c.execute('''
-            INSERT INTO password_reset_tokens (user_id, token, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user_id, token, expires_at))
+        with conn:
+            c.execute('''
+                INSERT INTO password_reset_tokens (user_id, token, expires_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, token, expires_at))
         
         token_id = c.lastrowid
-        conn.commit()
         
         # Log the activity
         ActivityLog.log_activity(user_id, 'PASSWORD_RESET_REQUESTED', 'Password reset token created')
         
-        conn.close()
         return token
     
     @staticmethod
     def get_valid_token(token):
         """Get valid (unused and not expired) token"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
         c.execute('''
@@ -380,7 +667,6 @@ class PasswordResetToken:
         ''', (token,))
         
         token_data = c.fetchone()
-        conn.close()
         
         if token_data:
             return PasswordResetToken(*token_data)
@@ -388,89 +674,109 @@ class PasswordResetToken:
     
     def mark_as_used(self):
         """Mark token as used"""
-        conn = sqlite3.connect('school.db')
+        conn = get_connection()
         c = conn.cursor()
         
-        c.execute('UPDATE password_reset_tokens SET used = 1 WHERE id = ?', (self.id,))
-        conn.commit()
+        with conn:
+            c.execute('UPDATE password_reset_tokens SET used = 1 WHERE id = ?', (self.id,))
         
         # Log the activity
         ActivityLog.log_activity(self.user_id, 'PASSWORD_RESET_COMPLETED', 'Password reset token used')
         
-        conn.close()
         self.used = True
 
 class ActivityLog:
     """Activity logging model"""
     
+    __slots__ = ('id', 'user_id', 'action', 'details', 'ip_address', 'timestamp', 'username', 'user_type')
+    
     def __init__(self, id=None, user_id=None, action=None, details=None, 
-                 ip_address=None, timestamp=None):
+                 ip_address=None, timestamp=None, username=None, user_type=None):
         self.id = id
         self.user_id = user_id
         self.action = action
         self.details = details
         self.ip_address = ip_address
         self.timestamp = timestamp
+        # Filled in by queries that join users
+        self.username = username
+        self.user_type = user_type
+    
+    # Log rows are written in batches by a background thread, off the request path
+    writer = BatchWriter('''
+        INSERT INTO activity_log (user_id, action, details, ip_address, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    ''')
     
     @staticmethod
     def log_activity(user_id, action, details=None, ip_address=None):
         """Log user activity"""
-        conn = sqlite3.connect('school.db')
-        c = conn.cursor()
-        
-        c.execute('''
-            INSERT INTO activity_log (user_id, action, details, ip_address)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, action, details, ip_address))
+        # Stamp the event now rather than when its batch is written
+        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        ActivityLog.writer.put((user_id, action, details, ip_address, timestamp))
+    
+    @staticmethod
+    def flush():
+        """Wait until every logged activity has been written"""
+        ActivityLog.writer.flush()
+    
+    @staticmethod
+    def get_user_activities(user_id, limit=50, before=None):
+        """Get user activities, newest first
         
-        conn.commit()
-        conn.close()
+        Pass the page_key() of the last activity returned as before to get
+        the next page; each page is an index range scan however deep it is.
+        """
+        return list(ActivityLog.iter_user_activities(user_id, limit, before))
     
     @staticmethod
-    def get_user_activities(user_id, limit=50):
-        """Get user activities"""
-        conn = sqlite3.connect('school.db')
+    def iter_user_activities(user_id, limit=None, before=None):
+        """Stream user activities, newest first; limit=None streams all of them"""
+        conn = get_connection()
         c = conn.cursor()
         
-        c.execute('''
+        before_clause = 'AND (timestamp, id) < (?, ?)' if before is not None else ''
+        params = (user_id,) + (tuple(before) if before is not None else ()) + (-1 if limit is None else limit,)
+        c.execute(f'''
             SELECT id, user_id, action, details, ip_address, timestamp
             FROM activity_log 
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
+            WHERE user_id = ? {before_clause}
+            ORDER BY timestamp DESC, id DESC
             LIMIT ?
-        ''', (user_id, limit))
+        ''', params)
         
-        activities = []
-        for row in c.fetchall():
-            activities.append(ActivityLog(*row))
-        
-        conn.close()
-        return activities
+        for row in iter_rows(c):
+            yield ActivityLog(*row)
     
     @staticmethod
-    def get_recent_activities(limit=100):
-        """Get recent activities (admin only)"""
-        conn = sqlite3.connect('school.db')
+    def get_recent_activities(limit=100, before=None):
+        """Get recent activities (admin only), newest first; before works as in get_user_activities"""
+        return list(ActivityLog.iter_recent_activities(limit, before))
+    
+    @staticmethod
+    def iter_recent_activities(limit=None, before=None):
+        """Stream recent activities with usernames, newest first; limit=None streams all of them"""
+        conn = get_connection()
         c = conn.cursor()
         
-        c.execute('''
+        before_clause = 'WHERE (al.timestamp, al.id) < (?, ?)' if before is not None else ''
+        params = (tuple(before) if before is not None else ()) + (-1 if limit is None else limit,)
+        c.execute(f'''
             SELECT al.id, al.user_id, al.action, al.details, al.ip_address, al.timestamp,
                    u.username, u.user_type
             FROM activity_log al
             LEFT JOIN users u ON al.user_id = u.id
-            ORDER BY al.timestamp DESC
+            {before_clause}
+            ORDER BY al.timestamp DESC, al.id DESC
             LIMIT ?
-        ''', (limit,))
-        
-        activities = []
-        for row in c.fetchall():
-            activity = ActivityLog(row[0], row[1], row[2], row[3], row[4], row[5])
-            activity.username = row[6]
-            activity.user_type = row[7]
-            activities.append(activity)
+        ''', params)
         
-        conn.close()
-        return activities
+        for row in iter_rows(c):
+            yield ActivityLog(*row)
+    
+    def page_key(self):
+        """Get the keyset position of this activity for paginating past it"""
+        return (self.timestamp, self.id)
 
 # Utility functions
 def get_subjects():
@@ -490,64 +796,47 @@ def get_grades():
     """Get list of all grades"""
     return list(range(1, 11))  # Grades 1-10
 
-def get_textbook_stats():
-    """Get textbook statistics"""
-    conn = sqlite3.connect('school.db')
+def get_catalogue_version(grade=None):
+    """Get the catalogue version of a grade; it changes whenever its textbooks change
+    
+    Without a grade, get a version covering every grade. Versions only ever
+    go up, so their sum changes whenever any of them does.
+    """
+    conn = get_connection()
     c = conn.cursor()
     
-    # Total textbooks
-    c.execute('SELECT COUNT(*) FROM textbooks WHERE is_active = 1')
-    total_textbooks = c.fetchone()[0]
-    
-    # Textbooks by grade
-    c.execute('''
-        SELECT grade, COUNT(*) 
-        FROM textbooks 
-        WHERE is_active = 1 
-        GROUP BY grade 
-        ORDER BY grade
-    ''')
-    by_grade = dict(c.fetchall())
-    
-    # Textbooks by subject
-    c.execute('''
-        SELECT subject, COUNT(*) 
-        FROM textbooks 
-        WHERE is_active = 1 
-        GROUP BY subject 
-        ORDER BY COUNT(*) DESC
-    ''')
-    by_subject = dict(c.fetchall())
+    if grade is None:
+        c.execute('SELECT COALESCE(SUM(version), 0) FROM catalogue_versions')
+    else:
+        c.execute('SELECT version FROM catalogue_versions WHERE grade = ?', (grade,))
+    row = c.fetchone()
+    
+    return row[0] if row else 0
+
+def get_stats_counters(name):
+    """Get the non-zero values of a trigger-maintained summary counter"""
+    conn = get_connection()
+    c = conn.cursor()
     
-    conn.close()
+    c.execute('SELECT key, count FROM stats_counters WHERE name = ? AND count > 0', (name,))
+    return c.fetchall()
+
+def get_textbook_stats():
+    """Get textbook statistics"""
+    by_grade = dict(sorted(get_stats_counters('active_textbooks_by_grade')))
+    by_subject = dict(sorted(get_stats_counters('active_textbooks_by_subject'), key=lambda item: -item[1]))
     
     return {
-        'total': total_textbooks,
+        'total': sum(by_grade.values()),
         'by_grade': by_grade,
         'by_subject': by_subject
     }
 
 def get_user_stats():
     """Get user statistics"""
-    conn = sqlite3.connect('school.db')
-    c = conn.cursor()
-    
-    # Total users
-    c.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-    total_users = c.fetchone()[0]
-    
-    # Users by type
-    c.execute('''
-        SELECT user_type, COUNT(*) 
-        FROM users 
-        WHERE is_active = 1 
-        GROUP BY user_type
-    ''')
-    by_type = dict(c.fetchall())
-    
-    conn.close()
+    by_type = dict(get_stats_counters('active_users_by_type'))
     
     return {
-        'total': total_users,
+        'total': sum(by_type.values()),
         'by_type': by_type
-    }
\ No newline at end of file
+    }
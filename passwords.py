@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; only serve.py shares slots between processes
+    fcntl = None
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Fully spelled out so stored hashes can be compared against it
+HASH_METHOD = 'scrypt:32768:8:1'
+WORKERS = max(1, (os.cpu_count() or 2) // 2)
+MAX_PENDING = 64             # hashes running or queued before logins are turned away
+RETRY_AFTER = 2              # seconds clients are asked to wait when saturated
+SLOT_POLL_INTERVAL = 0.005   # seconds between tries for a free slot shared with other processes
+
+
+class HashingBusy(Exception):
+    """Raised when the password hashing pool has no room for another job"""
+
+    def __init__(self, retry_after=RETRY_AFTER):
+        super().__init__('Password hashing pool is saturated')
+        self.retry_after = retry_after
+
+
+class HashSlots:
+    """Caps the hashes running at once across processes, with one file locked per running hash
+
+    The kernel drops the locks of a process that dies, so a worker killed
+    mid-hash can't leak a slot.
+    """
+
+    def __init__(self, folder, count):
+        self.folder = folder
+        self.count = count
+
+    @contextmanager
+    def hold(self):
+        os.makedirs(self.folder, exist_ok=True)
+        while True:
+            for slot in range(self.count):
+                fd = os.open(os.path.join(self.folder, f'slot{slot}'), os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                try:
+                    yield
+                finally:
+                    # Closing releases the lock
+                    os.close(fd)
+                return
+            time.sleep(SLOT_POLL_INTERVAL)
+
+
+class PasswordHasher:
+    """Runs password hashing and verification in a small dedicated thread pool
+
+    hashlib releases the GIL while it hashes, so a few threads use a few
+    cores and request threads only wait on their own result. At most
+    max_pending jobs are admitted at once; beyond that HashingBusy is raised
+    immediately instead of queueing. slots, if given, is a HashSlots shared
+    with other processes that every job must hold while it hashes.
+    """
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING, method=HASH_METHOD, slots=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.method = method
+        self.slots = slots
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            # Worker threads don't survive fork(), so each process gets its own pool
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._executor
+
+    def _run(self, fn, *args):
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise HashingBusy()
+            self._pending += 1
+        try:
+            return executor.submit(self._hold_slot, fn, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _hold_slot(self, fn, *args):
+        if self.slots is None:
+            return fn(*args)
+        with self.slots.hold():
+            return fn(*args)
+
+    def hash(self, password):
+        """Hash a password with the current method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Check a password against a stored hash"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Check if a stored hash was made with other parameters than the current method"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def pending(self):
+        """Get the number of jobs running or queued"""
+        with self._lock:
+            return self._pending
+
+
+hasher = PasswordHasher()
+
+
+def configure(workers=None, max_pending=None, method=None, slots=None):
+    """Change pool settings; takes effect for jobs submitted afterwards"""
+    global hasher
+    hasher = PasswordHasher(workers or hasher.workers,
+                            max_pending or hasher.max_pending,
+                            method or hasher.method,
+                            slots or hasher.slots)
+
+
+def init_app(app):
+    """Configure the pool from PASSWORD_HASH_* settings"""
+    configure(app.config.get('PASSWORD_HASH_WORKERS'),
+              app.config.get('PASSWORD_HASH_MAX_PENDING'),
+              app.config.get('PASSWORD_HASH_METHOD'))
@@ -0,0 +1,147 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it images get no thumbnails
+    Image = None
+
+PREVIEW_SIZE = 320          # longest side of a preview, in pixels
+WORKERS = 2
+RENDER_TIMEOUT = 60         # seconds allowed for an external renderer
+IMAGE_TYPES = {'jpg', 'jpeg', 'png'}
+
+# Previews live under <UPLOAD_FOLDER>/previews/ab/<sha256>.jpg, one per distinct file content
+PREVIEW_FOLDER = os.path.join('uploads/textbooks', 'previews')
+
+_lock = threading.Lock()
+_executor = None
+_pid = None
+_pending = {}
+
+
+def init_app(app):
+    """Keep previews next to the blob store and size the worker pool from PREVIEW_WORKERS"""
+    global PREVIEW_FOLDER, WORKERS
+    PREVIEW_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'previews')
+    WORKERS = app.config.get('PREVIEW_WORKERS', WORKERS)
+
+
+def preview_path(sha256):
+    """Get the path of the preview of some file content"""
+    return os.path.join(PREVIEW_FOLDER, sha256[:2], sha256 + '.jpg')
+
+
+def _failed_path(sha256):
+    return os.path.join(PREVIEW_FOLDER, sha256[:2], sha256 + '.failed')
+
+
+@functools.lru_cache(maxsize=None)
+def preview_types():
+    """Get the file types a preview can be rendered for with what is installed here"""
+    types = set()
+    if Image is not None:
+        types |= IMAGE_TYPES
+    if shutil.which('pdftoppm'):
+        types.add('pdf')
+    return frozenset(types)
+
+
+def render_preview(source, destination, file_type, size=PREVIEW_SIZE):
+    """Render a JPEG preview of source; runs in a worker process
+
+    A file that can't be rendered gets a .failed marker so it isn't retried.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # pdftoppm adds the .jpg extension to the prefix it is given
+    tmp_prefix = f'{destination}.{os.getpid()}'
+    tmp_path = tmp_prefix + '.jpg'
+    try:
+        if file_type in IMAGE_TYPES:
+            with Image.open(source) as image:
+                image.thumbnail((size, size))
+                image.convert('RGB').save(tmp_path, 'JPEG', quality=80, optimize=True)
+        elif file_type == 'pdf':
+            subprocess.run(['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-jpeg',
+                            '-scale-to', str(size), source, tmp_prefix],
+                           check=True, capture_output=True, timeout=RENDER_TIMEOUT)
+        else:
+            raise ValueError(f'No renderer for {file_type} files')
+        os.replace(tmp_path, destination)
+        return True
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with open(os.path.splitext(destination)[0] + '.failed', 'w'):
+            pass
+        return False
+
+
+def _get_executor():
+    global _executor, _pid
+    # Worker processes belong to the process that started them, so each fork gets its own pool
+    if _executor is None or _pid != os.getpid():
+        # Renderers start from a fresh interpreter: forking a threaded worker can copy a lock another
+        # thread holds, and a forkserver started before gunicorn forks can't be used by the workers
+        _executor = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        _pid = os.getpid()
+        _pending.clear()
+    return _executor
+
+
+def _done(sha256):
+    def callback(future):
+        with _lock:
+            _pending.pop(sha256, None)
+    return callback
+
+
+def schedule(sha256, file_type, source):
+    """Queue a preview for rendering in the worker pool unless it exists, failed or is queued
+
+    Returns the pending future, or None if there is nothing to do. source
+    must be a local file. Never renders on the calling thread.
+    """
+    if not sha256 or not source or file_type not in preview_types():
+        return None
+    if os.path.exists(preview_path(sha256)) or os.path.exists(_failed_path(sha256)):
+        return None
+
+    with _lock:
+        executor = _get_executor()
+        future = _pending.get(sha256)
+        if future is not None:
+            return future
+        future = executor.submit(render_preview, os.path.abspath(source), os.path.abspath(preview_path(sha256)),
+                                 file_type)
+        _pending[sha256] = future
+    future.add_done_callback(_done(sha256))
+    return future
+
+
+def delete(sha256):
+    """Remove the preview of some content, and any failure marker"""
+    for path in (preview_path(sha256), _failed_path(sha256)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def backfill(rows, progress=None):
+    """Render missing previews for (sha256, file_type, source) rows; returns (rendered, failed)"""
+    futures = [future for future in (schedule(*row) for row in rows) if future is not None]
+    rendered = failed = 0
+    for done, future in enumerate(futures, 1):
+        if future.result():
+            rendered += 1
+        else:
+            failed += 1
+        if progress:
+            progress(done, len(futures))
+    return rendered, failed
@@ -0,0 +1,313 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import hashlib
+import os
+import re
+import time
+
+from db import get_connection
+from models import Blob
+import storage
+import previews
+
+GRACE_SECONDS = 24 * 60 * 60       # files younger than this may belong to an upload still in progress
+SCRUB_RATE = 20 * 1024 * 1024      # bytes per second read while re-verifying checksums
+WORKERS = 8
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _scan_files(path, depth):
+    """Stat every file depth directory levels below path, keyed by file name"""
+    found = {}
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if depth and entry.is_dir(follow_symlinks=False):
+                    found.update(_scan_files(entry.path, depth - 1))
+                elif not depth and entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    found[entry.name] = (entry.path, stat.st_size, stat.st_mtime)
+    except FileNotFoundError:
+        pass
+    return found
+
+
+def scan_tree(root, depth, workers=WORKERS):
+    """Stat the files of a sharded tree, scanning each top-level shard in its own thread
+
+    depth is the number of shard directory levels, 2 for blobs (ab/cd/<sha256>)
+    and 1 for previews (ab/<sha256>.jpg). Returns {name: (path, size, mtime)}.
+    """
+    try:
+        with os.scandir(root) as entries:
+            shards = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return {}
+
+    found = {}
+    # scandir and stat release the GIL, so threads overlap the filesystem round trips
+    with ThreadPoolExecutor(workers) as executor:
+        for files in executor.map(_scan_files, shards, [depth - 1] * len(shards)):
+            found.update(files)
+    return found
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def reclaim_folder():
+    """Where blob files are moved while the reconciler makes sure nothing took them back"""
+    return os.path.join(os.path.dirname(storage.BLOB_FOLDER), 'reclaiming')
+
+
+def _restore(aside, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # An upload that found the file gone stores the same bytes, so either copy will do
+    os.replace(aside, path)
+
+
+def _reclaim(sha256, path, cutoff):
+    """Remove a blob file whose row is gone, unless an upload of the same content got to it first
+
+    The file is moved aside before the last checks, so a concurrent
+    store_file either touched it beforehand, which its mtime shows, or
+    finds it missing and stores its own copy. Returns True if removed.
+    """
+    aside = os.path.join(reclaim_folder(), sha256)
+    os.makedirs(reclaim_folder(), exist_ok=True)
+    try:
+        os.replace(path, aside)
+    except FileNotFoundError:
+        return False
+    if os.stat(aside).st_mtime > cutoff or Blob.get_by_sha256(sha256) is not None:
+        _restore(aside, path)
+        return False
+    _remove(aside)
+    return True
+
+
+def _recover_reclaiming():
+    """Finish reclaims an interrupted run left behind: put back what is referenced, remove the rest"""
+    for name, (aside, size, mtime) in _scan_files(reclaim_folder(), 0).items():
+        if not SHA256.match(name):
+            continue
+        if Blob.get_by_sha256(name) is not None:
+            _restore(aside, storage.backend.path(name))
+        else:
+            _remove(aside)
+
+
+def _purge_soft_deleted(conn, cutoff, dry_run):
+    """Remove textbooks soft-deleted before cutoff, leaving their blobs unreferenced
+
+    Returns the rows removed, or that would be removed on a dry run, as
+    (id, sha256, grade, subject, filename).
+    """
+    c = conn.cursor()
+    if not dry_run:
+        with conn:
+            # Rows soft-deleted before deleted_at existed start their grace period now
+            c.execute('UPDATE textbooks SET deleted_at = CURRENT_TIMESTAMP WHERE is_active = 0 AND deleted_at IS NULL')
+
+    # A dry run leaves deleted_at unset, so reads it as the now a real run would write
+    c.execute('''
+        SELECT id, sha256, grade, subject, filename FROM textbooks
+        WHERE is_active = 0 AND COALESCE(deleted_at, CURRENT_TIMESTAMP) <= datetime(?, 'unixepoch')
+    ''', (cutoff,))
+    rows = c.fetchall()
+    if dry_run or not rows:
+        return rows
+
+    with conn:
+        c.executemany('DELETE FROM textbooks WHERE id = ?', [(row[0],) for row in rows])
+    for _, sha256, grade, subject, filename in rows:
+        if not sha256:
+            _remove(storage.legacy_path(grade, subject, filename))
+    return rows
+
+
+def _expire_uploads(conn, cutoff, dry_run):
+    """Drop chunked upload sessions abandoned before cutoff; returns the ids still in progress"""
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, updated_at <= datetime(?, 'unixepoch') FROM upload_sessions
+    ''', (cutoff,))
+    sessions = c.fetchall()
+    expired = [upload_id for upload_id, abandoned in sessions if abandoned]
+    if expired and not dry_run:
+        with conn:
+            c.executemany('DELETE FROM upload_sessions WHERE id = ?', [(upload_id,) for upload_id in expired])
+    return len(expired), {upload_id for upload_id, abandoned in sessions if not abandoned}
+
+
+def reconcile(grace_seconds=GRACE_SECONDS, workers=WORKERS, dry_run=False):
+    """Diff the local blob store against the database and reclaim what nothing references
+
+    Soft-deleted textbooks, blobs no textbook points at, previews of content
+    that is gone and staged files of abandoned uploads are removed once they
+    are older than grace_seconds. Active textbooks whose file is missing are
+    only reported. With a remote storage backend only the blob store scan is
+    skipped; its unreferenced objects are counted, not removed. Returns a
+    report dict.
+    """
+    started = time.monotonic()
+    cutoff = time.time() - grace_seconds
+    conn = get_connection()
+    c = conn.cursor()
+
+    local = isinstance(storage.backend, storage.LocalStorage)
+    if local and not dry_run:
+        _recover_reclaiming()
+    purged = _purge_soft_deleted(conn, cutoff, dry_run)
+    expired_uploads, live_uploads = _expire_uploads(conn, cutoff, dry_run)
+
+    files = {}
+    if local:
+        files = {name: stat for name, stat in scan_tree(storage.BLOB_FOLDER, 2, workers).items()
+                 if SHA256.match(name)}
+    c.execute('SELECT sha256, ref_count FROM blobs')
+    ref_counts = dict(c.fetchall())
+    if dry_run:
+        # The purge didn't happen, so drop the references its deletes would have released
+        for _, sha256, _, _, _ in purged:
+            if sha256 in ref_counts:
+                ref_counts[sha256] -= 1
+
+    reclaimed, reclaimed_bytes = [], 0
+    for sha256, (path, size, mtime) in files.items():
+        if ref_counts.get(sha256, 0) > 0 or mtime > cutoff:
+            continue
+        if dry_run:
+            reclaimed.append(sha256)
+            reclaimed_bytes += size
+            continue
+        # Re-check against the database at the last moment; an upload may have just referenced it
+        if sha256 in ref_counts:
+            if not Blob.delete_if_unreferenced(sha256):
+                continue
+        elif Blob.get_by_sha256(sha256) is not None:
+            continue
+        if not _reclaim(sha256, path, cutoff):
+            continue
+        previews.delete(sha256)
+        reclaimed.append(sha256)
+        reclaimed_bytes += size
+
+    # Unreferenced blob rows whose file is already gone
+    forgotten = 0
+    for sha256, ref_count in ref_counts.items():
+        if local and ref_count <= 0 and sha256 not in files:
+            if dry_run or Blob.delete_if_unreferenced(sha256):
+                forgotten += 1
+
+    missing = []
+    c.execute('SELECT id, original_name, sha256, grade, subject, filename FROM textbooks WHERE is_active = 1')
+    for textbook_id, original_name, sha256, grade, subject, filename in c:
+        if sha256:
+            if local and sha256 not in files:
+                missing.append((textbook_id, original_name))
+        elif not os.path.isfile(storage.legacy_path(grade, subject, filename)):
+            missing.append((textbook_id, original_name))
+
+    live = {sha256 for sha256, ref_count in ref_counts.items() if ref_count > 0} - set(reclaimed)
+    orphaned_previews = 0
+    for name, (path, size, mtime) in scan_tree(previews.PREVIEW_FOLDER, 1, workers).items():
+        if os.path.splitext(name)[0] not in live and mtime <= cutoff:
+            if not dry_run:
+                _remove(path)
+            orphaned_previews += 1
+
+    stale_staging = 0
+    for name, (path, size, mtime) in _scan_files(storage.STAGING_FOLDER, 0).items():
+        if name.startswith('upload_') and name[len('upload_'):] in live_uploads:
+            continue
+        if mtime <= cutoff:
+            if not dry_run:
+                _remove(path)
+            stale_staging += 1
+
+    return {
+        'scanned_files': len(files),
+        'scanned_bytes': sum(size for _, size, _ in files.values()),
+        'purged_textbooks': len(purged),
+        'expired_uploads': expired_uploads,
+        'reclaimed_files': len(reclaimed),
+        'reclaimed_bytes': reclaimed_bytes,
+        'forgotten_blobs': forgotten,
+        'unreferenced_blobs': 0 if local else sum(1 for ref_count in ref_counts.values() if ref_count <= 0),
+        'orphaned_previews': orphaned_previews,
+        'stale_staging': stale_staging,
+        'missing': missing,
+        'seconds': time.monotonic() - started,
+        'dry_run': dry_run
+    }
+
+
+def _hash_throttled(f, rate, block_size=storage.BLOCK_SIZE):
+    """Hash a file object, sleeping as needed to read no faster than rate bytes per second"""
+    hasher = hashlib.sha256()
+    started = time.monotonic()
+    done = 0
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        hasher.update(block)
+        done += len(block)
+        if rate:
+            ahead = done / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return hasher.hexdigest()
+
+
+def verify_blobs(max_bytes, rate=SCRUB_RATE, progress=None):
+    """Re-hash stored blobs, least recently verified first, until max_bytes have been read
+
+    Each run picks up where the last one stopped, so a small nightly budget
+    eventually covers the whole store. Blobs that hash correctly get a new
+    verified_at; corrupt or missing ones keep theirs, so they are checked
+    again first next time. Works with any storage backend.
+    """
+    started = time.monotonic()
+    conn = get_connection()
+    c = conn.cursor()
+
+    # Collect the batch before writing, so updated rows aren't revisited through the index
+    batch, budget = [], 0
+    c.execute('SELECT sha256, size FROM blobs WHERE ref_count > 0 ORDER BY verified_at')
+    for sha256, size in c:
+        if budget >= max_bytes:
+            break
+        batch.append((sha256, size))
+        budget += size
+    c.close()
+
+    verified, verified_bytes, corrupt, missing = 0, 0, [], []
+    for done, (sha256, size) in enumerate(batch, 1):
+        if not storage.exists(sha256):
+            missing.append(sha256)
+        else:
+            with closing(storage.open_blob(sha256)) as f:
+                digest = _hash_throttled(f, rate)
+            if digest == sha256:
+                with conn:
+                    conn.execute('UPDATE blobs SET verified_at = CURRENT_TIMESTAMP WHERE sha256 = ?', (sha256,))
+                verified += 1
+                verified_bytes += size
+            else:
+                corrupt.append(sha256)
+        if progress:
+            progress(done, len(batch))
+
+    return {
+        'verified': verified,
+        'bytes': verified_bytes,
+        'corrupt': corrupt,
+        'missing': missing,
+        'seconds': time.monotonic() - started
+    }
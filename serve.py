@@ -0,0 +1,139 @@
+"""Production server: the app under gunicorn with pre-forked worker processes
+
+    python serve.py
+    python serve.py --bind 0.0.0.0:8000 --workers 8 --threads 4 --pidfile serve.pid
+
+Migrations, template compilation and other warm-up run once in the master,
+and workers are forked from it already loaded. Signals to the master:
+
+    HUP        replace every worker gracefully (the code loaded in the master is kept)
+    USR2       start a new master with the new code next to this one, its pid file
+               renamed to <pidfile>.oldbin; once the new workers answer, send
+    QUIT       to the old master to let its workers finish and stop, for a zero-downtime deploy
+    TTIN/TTOU  add or remove one worker
+    TERM       finish in-flight requests (up to SERVE_GRACEFUL_TIMEOUT) and stop
+
+Gunicorn only runs on Unix; use python app.py for local development.
+"""
+import os
+import shutil
+import tempfile
+
+import click
+from gunicorn.app.base import BaseApplication
+
+import db
+import metrics
+from models import ActivityLog
+import passwords
+import previews
+import template_cache
+
+
+def warm_up(app):
+    """Do once in the master what every worker would otherwise repeat on its first requests"""
+    from app import init_db
+
+    with app.app_context():
+        init_db()
+        template_cache.precompile(app)
+        previews.preview_types()
+    metrics.clear()
+    # Workers open their own connections; one inherited across fork() must never be used
+    db.close_all()
+
+
+def hash_slots_folder(server):
+    # Keyed by the master, so a new master started by USR2 gets its own budget
+    return os.path.join(tempfile.gettempdir(), f'password-slots-{server.pid}')
+
+
+def size_password_pool(config, workers, threads, slots_folder, cpus=None):
+    """Give this worker its share of the password hashing budget, unless PASSWORD_HASH_* settings fix it
+
+    Half the cores hash at most for the whole server: each worker gets an
+    even share of threads, rounded up, and slots shared by every worker
+    keep the total running at once within the budget. Admitting fewer
+    hashes than the worker has request threads means a burst of logins gets
+    503 while the other threads keep serving pages.
+    """
+    budget = max(1, (cpus or os.cpu_count() or 2) // 2)
+    slots = None
+    if not config['PASSWORD_HASH_WORKERS']:
+        slots = passwords.HashSlots(slots_folder, budget)
+    passwords.configure(config['PASSWORD_HASH_WORKERS'] or -(-budget // workers),
+                        config['PASSWORD_HASH_MAX_PENDING'] or max(1, threads - 1),
+                        slots=slots)
+
+
+def post_fork(server, worker):
+    metrics.reset()
+    size_password_pool(server.app.application.config, server.num_workers, server.cfg.threads,
+                       hash_slots_folder(server))
+    server.log.info('Worker %s ready', worker.pid)
+
+
+def on_exit(server):
+    shutil.rmtree(hash_slots_folder(server), ignore_errors=True)
+
+
+def worker_exit(server, worker):
+    # Recycled and reloaded workers write out activity still queued in memory before they go
+    ActivityLog.writer.close()
+    # Its counts are folded into the shared metrics at the next scrape
+    metrics.flush()
+
+
+class Server(BaseApplication):
+    """Gunicorn application serving an already imported Flask app"""
+
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def server_options(config, bind=None, workers=None, threads=None, pidfile=None):
+    """Build gunicorn settings from the app config, with command line overrides"""
+    return {
+        'bind': bind or config['SERVE_BIND'],
+        'workers': workers or config['SERVE_WORKERS'],
+        # Threaded workers keep serving pages while a thread streams a large download
+        'worker_class': 'gthread',
+        'threads': threads or config['SERVE_THREADS'],
+        'preload_app': True,
+        'max_requests': config['SERVE_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVE_MAX_REQUESTS_JITTER'],
+        'timeout': config['SERVE_TIMEOUT'],
+        'graceful_timeout': config['SERVE_GRACEFUL_TIMEOUT'],
+        'keepalive': config['SERVE_KEEPALIVE'],
+        'pidfile': pidfile,
+        'accesslog': '-',
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'on_exit': on_exit,
+    }
+
+
+@click.command()
+@click.option('--bind', default=None, help='Address to listen on (default: SERVE_BIND)')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: SERVE_WORKERS)')
+@click.option('--threads', type=int, default=None, help='Threads per worker (default: SERVE_THREADS)')
+@click.option('--pidfile', type=click.Path(dir_okay=False), default=None, help='Write the master PID here')
+def main(bind, workers, threads, pidfile):
+    """Serve the app with pre-forked gunicorn workers"""
+    from app import app
+
+    warm_up(app)
+    Server(app, server_options(app.config, bind, workers, threads, pidfile)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import secrets
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from db import get_connection
+
+TOUCH_INTERVAL = 60 * 60       # seconds before an unchanged session's expiry is pushed back again
+PURGE_INTERVAL = 10 * 60       # seconds between sweeps of expired sessions, per process
+
+serializer = TaggedJSONSerializer()
+_last_purge = 0
+
+
+def load_secret_key(path):
+    """Read the secret key from path, generating it on first use so every worker and restart shares it"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secrets.token_hex(32))
+    try:
+        # link fails if another worker got there first, and then its key wins
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _key(sid):
+    # Only a hash of the id is stored, so a copy of the database can't be used to take over sessions
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept in the database; the cookie only carries a signed random id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=0):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.stale_sid = None
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def regenerate(self):
+        """Move the data to a new id, so an id seen before logging in or out stops working"""
+        if self.sid is not None:
+            self.stale_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Sessions in the app database, shared by every worker process and kept across restarts
+
+    Requests without a session cookie never touch the database. An unchanged
+    session is read with one primary key lookup and written back at most
+    once per TOUCH_INTERVAL to extend its expiry.
+    """
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-session', key_derivation='hmac')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession()
+
+        try:
+            sid = self._signer(app).unsign(cookie).decode()
+        except BadSignature:
+            sid = None
+        if sid:
+            row = get_connection().execute('SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?',
+                                           (_key(sid), int(time.time()))).fetchone()
+            if row:
+                return ServerSession(serializer.loads(row[0]), sid, row[1])
+
+        # Expired or forged; marking it modified makes save_session drop the cookie
+        session = ServerSession()
+        session.modified = True
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        conn = get_connection()
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.stale_sid:
+            with conn:
+                conn.execute('DELETE FROM sessions WHERE id = ?', (_key(session.stale_sid),))
+
+        if not session:
+            if session.modified:
+                if session.sid:
+                    with conn:
+                        conn.execute('DELETE FROM sessions WHERE id = ?', (_key(session.sid),))
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        now = int(time.time())
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        if not session.modified and session.expires_at - now > lifetime - TOUCH_INTERVAL:
+            return
+
+        expires_at = now + lifetime
+        if session.modified:
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+            with conn:
+                conn.execute('''
+                    INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+                ''', (_key(session.sid), serializer.dumps(dict(session)), expires_at))
+        else:
+            with conn:
+                conn.execute('UPDATE sessions SET expires_at = ? WHERE id = ?', (expires_at, _key(session.sid)))
+        purge_expired(now)
+
+        # A browser-session cookie stays valid as long as the row does, so only new ids need sending
+        if session.modified or session.permanent:
+            response.set_cookie(name, self._signer(app).sign(session.sid).decode(),
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def purge_expired(now=None, force=False):
+    """Delete expired sessions, at most once per PURGE_INTERVAL unless forced; returns the number removed"""
+    global _last_purge
+    now = now or int(time.time())
+    if not force and now - _last_purge < PURGE_INTERVAL:
+        return 0
+    _last_purge = now
+
+    conn = get_connection()
+    with conn:
+        return conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,)).rowcount
+
+
+def init_app(app):
+    """Keep sessions server-side, signing their ids with SECRET_KEY or a key generated once in SECRET_KEY_FILE"""
+    if not app.secret_key:
+        app.secret_key = load_secret_key(app.config['SECRET_KEY_FILE'])
+    app.session_interface = SQLiteSessionInterface()
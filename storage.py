@@ -0,0 +1,254 @@
+import hashlib
+import os
+import secrets
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 is only needed for the s3 backend
+    boto3 = None
+
+    class ClientError(Exception):
+        """Stands in for botocore's error, so S3Storage still works with a client passed in"""
+
+        def __init__(self, error_response, operation_name):
+            super().__init__(f'{operation_name}: {error_response["Error"]["Code"]}')
+            self.response = error_response
+            self.operation_name = operation_name
+
+BLOCK_SIZE = 1024 * 1024
+PRESIGN_EXPIRES = 300        # seconds a presigned download link stays valid
+
+# Content-addressed blobs live under <UPLOAD_FOLDER>/blobs/ab/cd/<sha256> (or the same keys in a bucket)
+UPLOAD_FOLDER = 'uploads/textbooks'
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, 'staging')
+
+
+def shard(sha256):
+    """Get the relative location of a blob, sharded by the first two bytes of its hash"""
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+class LocalStorage:
+    """Blobs on a local or shared filesystem; two levels of sharding keep every directory small"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.location = folder
+
+    def path(self, sha256):
+        return os.path.join(self.folder, *shard(sha256).split('/'))
+
+    def local_path(self, sha256):
+        return self.path(sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def size(self, sha256):
+        return os.path.getsize(self.path(sha256))
+
+    def open(self, sha256):
+        return open(self.path(sha256), 'rb')
+
+    def store_file(self, path, sha256):
+        destination = self.path(sha256)
+        try:
+            # Restart the reconciler's grace period, since a new row is about to reference this content
+            os.utime(destination)
+        except FileNotFoundError:
+            pass  # not stored yet, or the reconciler just took it away; store this copy
+        else:
+            os.remove(path)
+            return destination
+
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # Rename within one filesystem is atomic, so readers never see a partial blob
+        os.replace(path, destination)
+        return destination
+
+    def delete(self, sha256):
+        try:
+            os.remove(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def download_url(self, sha256, content_disposition, mimetype):
+        # Served by send_file or the front proxy instead
+        return None
+
+
+class S3Storage:
+    """Blobs in an S3-compatible bucket; downloads are presigned redirects straight to the bucket
+
+    endpoint_url points the driver at another S3 implementation, such as a
+    local MinIO or moto server for testing.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 presign_expires=PRESIGN_EXPIRES, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError('The s3 storage backend needs boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.presign_expires = presign_expires
+        self.location = f's3://{bucket}/{prefix}blobs/'
+
+    def key(self, sha256):
+        return f'{self.prefix}blobs/{shard(sha256)}'
+
+    def local_path(self, sha256):
+        return None
+
+    def _head(self, sha256):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(sha256))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, sha256):
+        return self._head(sha256) is not None
+
+    def size(self, sha256):
+        return self._head(sha256)['ContentLength']
+
+    def open(self, sha256):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(sha256))['Body']
+
+    def store_file(self, path, sha256):
+        # Content-addressed, so an existing object already holds these bytes
+        if not self.exists(sha256):
+            self.client.upload_file(path, self.bucket, self.key(sha256),
+                                    ExtraArgs={'ContentType': 'application/octet-stream'})
+        os.remove(path)
+        return self.key(sha256)
+
+    def delete(self, sha256):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(sha256))
+
+    def download_url(self, sha256, content_disposition, mimetype):
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(sha256),
+            'ResponseContentDisposition': content_disposition,
+            'ResponseContentType': mimetype
+        }, ExpiresIn=self.presign_expires)
+
+
+backend = LocalStorage(BLOB_FOLDER)
+
+
+def init_app(app):
+    """Point storage at the app's upload folder and pick the backend from STORAGE_BACKEND"""
+    global UPLOAD_FOLDER, BLOB_FOLDER, STAGING_FOLDER, backend
+    UPLOAD_FOLDER = app.config['UPLOAD_FOLDER']
+    BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+    STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, 'staging')
+
+    if app.config.get('STORAGE_BACKEND', 'local') == 's3':
+        backend = S3Storage(app.config['S3_BUCKET'], app.config.get('S3_PREFIX', ''),
+                            app.config.get('S3_ENDPOINT_URL'), app.config.get('S3_REGION'),
+                            app.config.get('S3_PRESIGN_EXPIRES', PRESIGN_EXPIRES))
+    else:
+        backend = LocalStorage(BLOB_FOLDER)
+
+
+def local_path(sha256):
+    """Get the filesystem path of a blob, or None if the backend isn't a filesystem"""
+    return backend.local_path(sha256)
+
+
+def exists(sha256):
+    """Check if a blob is stored"""
+    return backend.exists(sha256)
+
+
+def open_blob(sha256):
+    """Open a blob for reading as a binary file-like object"""
+    return backend.open(sha256)
+
+
+def download_url(sha256, content_disposition, mimetype):
+    """Get a URL clients can download a blob from directly, or None to send it from here"""
+    return backend.download_url(sha256, content_disposition, mimetype)
+
+
+def legacy_path(grade, subject, filename):
+    """Get the pre-blob path of an uploaded textbook"""
+    return os.path.join(UPLOAD_FOLDER, f'grade_{grade}', subject, filename)
+
+
+def staging_path(name=None):
+    """Get a path in the local staging area, which is on the same filesystem as local blobs"""
+    os.makedirs(STAGING_FOLDER, exist_ok=True)
+    return os.path.join(STAGING_FOLDER, name or secrets.token_hex(16))
+
+
+def hash_file(path):
+    """Get the SHA-256 hex digest and size of a file"""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+            size += len(block)
+    return hasher.hexdigest(), size
+
+
+def store_file(path, sha256):
+    """Move a staged file into the blob store; a copy of content already stored is dropped"""
+    return backend.store_file(path, sha256)
+
+
+def save_stream(stream):
+    """Stream data into the blob store, returning its SHA-256 and size"""
+    path = staging_path()
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                block = stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                f.write(block)
+                hasher.update(block)
+                size += len(block)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    sha256 = hasher.hexdigest()
+    store_file(path, sha256)
+    return sha256, size
+
+
+def delete_blob(sha256):
+    """Remove a blob if it exists"""
+    backend.delete(sha256)
+
+
+def migrate_legacy_uploads(rows):
+    """Move legacy grade/subject files into the blob store in place
+
+    rows are (id, grade, subject, filename) tuples. Yields (id, sha256, size)
+    for each file converted; the caller records the hash before the file is
+    moved, so an interrupted run can simply be repeated.
+    """
+    for textbook_id, grade, subject, filename in rows:
+        path = legacy_path(grade, subject, filename)
+        if not os.path.isfile(path):
+            continue
+
+        sha256, size = hash_file(path)
+        yield textbook_id, sha256, size
+        store_file(path, sha256)
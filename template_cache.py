@@ -0,0 +1,23 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+CACHE_FOLDER = 'cache/templates'
+
+
+def init_app(app):
+    """Keep compiled templates on disk so new workers load bytecode instead of compiling"""
+    folder = app.config.get('TEMPLATE_CACHE_FOLDER', CACHE_FOLDER)
+    if not folder:
+        return
+    os.makedirs(folder, exist_ok=True)
+    # Entries are keyed by a checksum of the source, so edited templates are recompiled
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.path.abspath(folder))
+
+
+def precompile(app):
+    """Compile every template into the bytecode cache and the app's in-memory cache"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
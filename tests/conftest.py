@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from database import migrate
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A migrated, empty database used by every connection for the length of a test"""
+    previous = db.DATABASE
+    db.configure(database=str(tmp_path / 'school.db'))
+    migrate(db.get_connection())
+    yield db.get_connection()
+    db.configure(database=previous)
+
+
+@pytest.fixture(scope='session')
+def flask_app(tmp_path_factory):
+    """The app, imported once from a scratch directory so the files it creates on import land there"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        from app import app
+    finally:
+        os.chdir(cwd)
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(flask_app, database):
+    """A test client for the app, using the database fixture's database"""
+    # Importing the app configured db with its own DATABASE; point both back at the fixture's
+    flask_app.config['DATABASE'] = db.DATABASE
+    db.configure(database=db.DATABASE)
+    return flask_app.test_client()
@@ -0,0 +1,36 @@
+import threading
+import time
+
+import passwords
+
+
+def test_slots_cap_hashes_running_at_once(tmp_path):
+    slots = passwords.HashSlots(str(tmp_path), 2)
+    lock = threading.Lock()
+    running, most = 0, 0
+
+    def hash_once():
+        nonlocal running, most
+        with slots.hold():
+            with lock:
+                running += 1
+                most = max(most, running)
+            time.sleep(0.02)
+            with lock:
+                running -= 1
+
+    threads = [threading.Thread(target=hash_once) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert most == 2
+
+
+def test_hasher_holds_a_slot_while_hashing(tmp_path):
+    hasher = passwords.PasswordHasher(workers=1, method='pbkdf2:sha256:1000',
+                                      slots=passwords.HashSlots(str(tmp_path), 1))
+
+    assert hasher.verify(hasher.hash('secret'), 'secret')
+    assert (tmp_path / 'slot0').exists()
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from models import Blob, Textbook
+import reconcile
+import storage
+from storage import S3Storage
+from test_storage import FakeS3Client
+
+OLD = 1000000000  # an mtime well past any grace period
+
+
+@pytest.fixture
+def blobs(database, tmp_path, monkeypatch):
+    """Put the blob store in a temporary folder and get a function writing old blobs into it"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 'BLOB_FOLDER', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(storage, 'backend', storage.LocalStorage(storage.BLOB_FOLDER))
+
+    def write(sha256, content=b'content'):
+        path = storage.backend.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (OLD, OLD))
+    return write
+
+
+def test_dry_run_counts_blobs_released_by_purged_textbooks(blobs):
+    deleted, orphan = 'a' * 64, 'b' * 64
+    blobs(deleted)
+    blobs(orphan)
+    textbook_id = Textbook.create_textbook('old.pdf', 'old.pdf', 5, 'Science', 'pdf', 7, 'admin', sha256=deleted)
+    Textbook.get_by_id(textbook_id).delete()
+
+    dry_run = reconcile.reconcile(grace_seconds=0, dry_run=True)
+    assert dry_run['purged_textbooks'] == 1
+    assert dry_run['reclaimed_files'] == 2
+    assert Textbook.get_by_id(textbook_id) is not None
+    assert storage.exists(deleted)
+
+    real = reconcile.reconcile(grace_seconds=0)
+    assert real['purged_textbooks'] == 1
+    assert real['reclaimed_files'] == 2
+    assert not storage.exists(deleted) and not storage.exists(orphan)
+
+
+def test_blob_shared_with_an_active_textbook_is_kept(blobs):
+    shared = 'c' * 64
+    blobs(shared)
+    Textbook.create_textbook('kept.pdf', 'kept.pdf', 5, 'Science', 'pdf', 7, 'admin', sha256=shared)
+    textbook_id = Textbook.create_textbook('gone.pdf', 'gone.pdf', 5, 'Science', 'pdf', 7, 'admin', sha256=shared)
+    Textbook.get_by_id(textbook_id).delete()
+
+    assert reconcile.reconcile(grace_seconds=0, dry_run=True)['reclaimed_files'] == 0
+    assert reconcile.reconcile(grace_seconds=0)['reclaimed_files'] == 0
+    assert storage.exists(shared)
+
+
+def test_upload_landing_while_a_blob_is_reclaimed_keeps_its_file(database, blobs, tmp_path, monkeypatch):
+    sha256 = 'd' * 64
+    blobs(sha256)
+    staged = tmp_path / 'staged'
+    delete_if_unreferenced = Blob.delete_if_unreferenced
+
+    def upload_after_delete(sha):
+        # The same content is uploaded right after the reconciler forgets the row
+        deleted = delete_if_unreferenced(sha)
+        staged.write_bytes(b'content')
+        storage.store_file(str(staged), sha)
+        Textbook.create_textbook('new.pdf', 'new.pdf', 5, 'Science', 'pdf', 7, 'admin', sha256=sha)
+        return deleted
+    monkeypatch.setattr(Blob, 'delete_if_unreferenced', staticmethod(upload_after_delete))
+    with database:
+        database.execute('INSERT INTO blobs (sha256, size, ref_count) VALUES (?, 7, 0)', (sha256,))
+
+    report = reconcile.reconcile(grace_seconds=0)
+
+    assert report['reclaimed_files'] == 0
+    assert storage.exists(sha256)
+    assert not os.listdir(reconcile.reclaim_folder())
+
+
+def test_database_and_staging_are_reclaimed_with_remote_storage(database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 'backend', S3Storage('textbooks', client=FakeS3Client()))
+    monkeypatch.setattr(storage, 'STAGING_FOLDER', str(tmp_path / 'staging'))
+    textbook_id = Textbook.create_textbook('old.pdf', 'old.pdf', 5, 'Science', 'pdf', 7, 'admin', sha256='e' * 64)
+    Textbook.get_by_id(textbook_id).delete()
+    staged = tmp_path / 'staging' / 'upload_abandoned'
+    staged.parent.mkdir()
+    staged.write_bytes(b'partial')
+    os.utime(staged, (OLD, OLD))
+
+    report = reconcile.reconcile(grace_seconds=0)
+
+    assert report['purged_textbooks'] == 1
+    assert report['stale_staging'] == 1
+    assert report['unreferenced_blobs'] == 1
+    assert Textbook.get_by_id(textbook_id) is None
+    assert not staged.exists()
@@ -0,0 +1,79 @@
+from models import Textbook
+
+
+def add(original_name, grade=5, subject='Mathematics', description=None):
+    return Textbook.create_textbook(f'{original_name}.pdf', original_name, grade, subject,
+                                    'pdf', 1024, 'admin', description)
+
+
+def test_short_last_word_matches_whole_words_only(database):
+    add('A Algebra Primer')
+    add('Al Gore Atlas')
+
+    # One or two letters would expand to nearly every term in the index
+    assert [t.original_name for t, _ in Textbook.search('a')] == ['A Algebra Primer']
+    assert [t.original_name for t, _ in Textbook.search('al')] == ['Al Gore Atlas']
+
+
+def test_last_word_of_min_prefix_length_matches_as_prefix(database):
+    add('Algebra Primer')
+    add('Algorithms for Kids')
+    add('Geography')
+
+    names = {t.original_name for t, _ in Textbook.search('alg')}
+    assert names == {'Algebra Primer', 'Algorithms for Kids'}
+
+
+def add_many(conn, count, original_name, file_type='pdf'):
+    with conn:
+        conn.executemany('''
+            INSERT INTO textbooks (filename, original_name, grade, subject, file_type, file_size, uploaded_by)
+            VALUES (?, ?, 5, 'Mathematics', ?, 1024, 'admin')
+        ''', [(f'{original_name} {i}.{file_type}', f'{original_name} {i}.{file_type}', file_type)
+              for i in range(count)])
+
+
+def test_filtered_matches_behind_many_older_ones_are_found(database):
+    add_many(database, 1200, 'Algebra notes')
+    add_many(database, 5, 'Algebra lesson video', 'mp4')
+
+    results = Textbook.search('algebra', file_type='mp4')
+    assert len(results) == 5
+    assert all(t.file_type == 'mp4' for t, _ in results)
+
+
+def test_best_match_ranks_first_however_new(database):
+    add_many(database, 1200, 'Algebra and geometry notes for the whole year')
+    newest = add('Algebra')
+
+    (best, _), = Textbook.search('algebra', limit=1)
+    assert best.id == newest
+
+
+def test_pages_reach_past_a_thousand_matches(database):
+    add_many(database, 1200, 'Algebra notes')
+
+    assert len(Textbook.search('algebra', limit=100, offset=1150)) == 50
+
+
+def test_soft_deleted_textbooks_are_left_out(database):
+    kept = add('Algebra Primer')
+    Textbook.get_by_id(add('Algebra Workbook')).delete()
+
+    assert [t.id for t, _ in Textbook.search('algebra')] == [kept]
+
+
+def test_grade_and_subject_filters(database):
+    add('Algebra Primer', grade=5, subject='Mathematics')
+    add('Algebra Workbook', grade=6, subject='Mathematics')
+    add('Algebra Stories', grade=5, subject='English')
+
+    results = Textbook.search('algebra', grade=5, subject='Mathematics')
+    assert [t.original_name for t, _ in results] == ['Algebra Primer']
+
+
+def test_snippet_marks_matched_terms(database):
+    add('Algebra Primer', description='Equations and algebraic thinking')
+
+    (textbook, snippet), = Textbook.search('algebra')
+    assert '\x02Algebra\x03' in snippet
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import storage
+from storage import ClientError, S3Storage
+
+SHA256 = 'ab' * 32
+
+
+class FakeS3Client:
+    """Just enough of a boto3 S3 client for S3Storage, keeping objects in a dict"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Bucket, Key])}
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        with open(path, 'rb') as f:
+            self.objects[bucket, key] = f.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+@pytest.fixture
+def s3():
+    return S3Storage('textbooks', 'school/', client=FakeS3Client())
+
+
+def test_missing_object_does_not_exist(s3):
+    assert not s3.exists(SHA256)
+
+
+def test_stored_object_exists(s3, tmp_path):
+    path = tmp_path / 'upload'
+    path.write_bytes(b'content')
+
+    assert s3.store_file(str(path), SHA256) == f'school/blobs/ab/ab/{SHA256}'
+    assert s3.exists(SHA256)
+    assert s3.size(SHA256) == len(b'content')
+    assert not path.exists()
+
+
+def test_other_errors_are_raised(s3):
+    def forbidden(Bucket, Key):
+        raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    s3.client.head_object = forbidden
+
+    with pytest.raises(ClientError):
+        s3.exists(SHA256)
+
+
+def test_preview_is_not_scheduled_without_local_storage(client, s3, tmp_path, monkeypatch):
+    from models import Textbook
+    import previews
+
+    monkeypatch.setattr(previews, 'PREVIEW_FOLDER', str(tmp_path / 'previews'))
+    textbook_id = Textbook.create_textbook('photo.jpg', 'photo.jpg', 5, 'Science', 'jpg', 7, 'admin',
+                                           sha256=SHA256)
+    monkeypatch.setattr(storage, 'backend', s3)
+    monkeypatch.setattr(previews, 'preview_types', lambda: frozenset({'jpg'}))
+
+    response = client.get(f'/textbooks/{textbook_id}/preview')
+
+    assert response.status_code == 404
+    assert 'Retry-After' not in response.headers
+    assert not os.path.exists(previews._failed_path(SHA256))
+    assert not previews._pending
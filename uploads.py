@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the development server there is a single process
+    fcntl = None
+
+from werkzeug.exceptions import ClientDisconnected
+
+BLOCK_SIZE = 1024 * 1024  # read request bodies 1MB at a time
+
+_fallback_lock = threading.Lock()
+
+
+@contextmanager
+def locked(path):
+    """Open the partial file of an upload under an exclusive lock held across every worker process
+
+    Callers re-read the upload's offset once they hold the lock, so two
+    requests for the same upload can never write or truncate at once.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+b') as f:
+        if fcntl is not None:
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+        else:
+            with _fallback_lock:
+                yield f
+
+
+def append_chunk(f, offset, stream, limit):
+    """Stream a chunk into a locked partial file at an already validated offset and return the new offset
+
+    Writing stops at limit bytes. A client that disconnects mid-chunk keeps
+    everything received so far, so it can resume from the returned offset.
+    """
+    # Drop bytes past the offset left behind by an interrupted chunk
+    f.seek(offset)
+    f.truncate()
+    try:
+        while offset < limit:
+            block = stream.read(min(BLOCK_SIZE, limit - offset))
+            if not block:
+                break
+            f.write(block)
+            offset += len(block)
+    except ClientDisconnected:
+        pass
+    f.flush()
+    return offset
+
+
+def digest(f, length):
+    """Hash the first length bytes of a locked partial file, as stored on disk"""
+    hasher = hashlib.sha256()
+    f.seek(0)
+    remaining = length
+    while remaining:
+        block = f.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            raise ValueError('Partial upload is shorter than the recorded offset')
+        hasher.update(block)
+        remaining -= len(block)
+    return hasher.hexdigest()